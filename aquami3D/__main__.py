@@ -0,0 +1,6 @@
+"""python -m aquami3D runs the aquami3d command (see cli.py)."""
+import sys
+
+from .cli import main
+
+sys.exit(main())
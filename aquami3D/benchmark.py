@@ -0,0 +1,263 @@
+"""Throughput benchmarks for the loaders and measurement stages.
+
+Run with python -m aquami3D.benchmark to benchmark on synthetic data, or
+pass a file path.  Thinning is also compared on the example stack in
+example_data.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from .xyz import read_xyz_positions, read_xyz_positions_parallel
+from .tiling import tiled_skeleton
+from .resample import resample_binary
+from .thinning import thin
+from .measure import skeletonize
+
+# TIFF stack of the repository, used as real data where it exists.
+EXAMPLE_STACK = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'example_data', 'fib serial section small.tif')
+
+
+def write_synthetic_xyz(file_path, n_atoms, seed=0):
+    # Writes an OVITO style XYZ file with a species column before 'pos'.
+    rng = np.random.RandomState(seed)
+    pos = rng.uniform(0, 400, (n_atoms, 3))
+    with open(file_path, 'w') as f:
+        f.write('{}\n'.format(n_atoms))
+        f.write('Lattice="400.0 0.0 0.0 0.0 400.0 0.0 0.0 0.0 400.0" '
+                'Properties=species:S:1:pos:R:3:id:I:1\n')
+        block = 100000
+        for i in range(0, n_atoms, block):
+            chunk = pos[i:i + block]
+            ids = np.arange(i, i + len(chunk))
+            f.write(''.join('Au {:.6f} {:.6f} {:.6f} {}\n'.format(x, y, z, j)
+                            for (x, y, z), j in zip(chunk, ids)))
+
+
+def legacy_read_xyz_positions(file_path):
+    # The per-token generator formerly used by inout.read_xyz, kept as the
+    # reference point for the benchmark.
+    with open(file_path, 'r') as f:
+        next(f)
+        meta = f.readline()
+    meta = meta.split('Properties=')[1].split('pos')[0].split(':')
+    skipcols = sum([int(i) for i in meta[2::3]])
+
+    def iter_func():
+        with open(file_path, 'r') as infile:
+            next(infile)
+            next(infile)
+            for line in infile:
+                line = line.rstrip().split(' ')[skipcols:skipcols + 3]
+                for item in line:
+                    yield float(item)
+
+    return np.fromiter(iter_func(), dtype=float).reshape((-1, 3))
+
+
+def time_call(func, *args, **kwargs):
+    t = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - t
+
+
+def peak_memory(func, *args, **kwargs):
+    # (result, seconds, peak bytes allocated by numpy and Python).
+    tracemalloc.start()
+    try:
+        result, t = time_call(func, *args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, t, peak
+
+
+def _synthetic_path(file_path, n_atoms):
+    # Returns (path, is_temporary), writing a synthetic dump if needed.
+    if file_path is not None:
+        return file_path, False
+    tmp = tempfile.NamedTemporaryFile(suffix='.xyz', delete=False)
+    tmp.close()
+    write_synthetic_xyz(tmp.name, n_atoms)
+    return tmp.name, True
+
+
+def benchmark_xyz_parsing(file_path=None, n_atoms=2000000):
+    """Prints the atoms/second of the block parser and the legacy parser."""
+    file_path, tmp = _synthetic_path(file_path, n_atoms)
+    try:
+        new, t_new = time_call(read_xyz_positions, file_path)
+        old, t_old = time_call(legacy_read_xyz_positions, file_path)
+        assert np.array_equal(new, old), 'parsers disagree'
+        print('atoms: {}'.format(len(new)))
+        print('block parser:  {:.3g} atoms/s ({:.2f} s)'.format(
+            len(new) / t_new, t_new))
+        print('legacy parser: {:.3g} atoms/s ({:.2f} s)'.format(
+            len(old) / t_old, t_old))
+        print('speedup: {:.1f}x'.format(t_old / t_new))
+    finally:
+        if tmp:
+            os.remove(file_path)
+
+
+def benchmark_parallel_xyz(file_path=None, n_atoms=4000000,
+                           processes=(1, 2, 4, 8)):
+    """Prints the load time of the process-parallel XYZ loader."""
+    file_path, tmp = _synthetic_path(file_path, n_atoms)
+    try:
+        serial, t_serial = time_call(read_xyz_positions, file_path)
+        print('serial: {:.2f} s'.format(t_serial))
+        for n in processes:
+            data, t = time_call(read_xyz_positions_parallel, file_path,
+                                processes=n)
+            assert np.array_equal(data, serial), 'loaders disagree'
+            print('{} processes: {:.2f} s ({:.1f}x)'.format(
+                n, t, t_serial / t))
+    finally:
+        if tmp:
+            os.remove(file_path)
+
+
+def synthetic_volume(shape=(256, 256, 256), sigma=3.0, seed=0):
+    # A bicontinuous, foam-like bool volume: thresholded smoothed noise.
+    from scipy import ndimage
+    rng = np.random.RandomState(seed)
+    noise = ndimage.gaussian_filter(rng.standard_normal(shape), sigma)
+    return noise > 0
+
+
+def example_volume():
+    # The example stack as a bool volume, or None if it is not there.
+    if not os.path.exists(EXAMPLE_STACK):
+        return None
+    from .inout import read_tiff_stack
+    return read_tiff_stack(EXAMPLE_STACK)
+
+
+def benchmark_tiled_measurement(im=None, tile_shape=(64, 64, 64),
+                                processes=(1, 2, 4, 8)):
+    """Prints the wall time of the tiled skeleton stage per process count.
+
+    The sum of the per-tile times over the wall time is the number of
+    cores kept busy.
+    """
+    if im is None:
+        im = synthetic_volume()
+    print('volume: {}, tiles: {}'.format(im.shape, tile_shape))
+    t_serial = None
+    for n in processes:
+        (_, timings), t = time_call(tiled_skeleton, im, tile_shape,
+                                    processes=n)
+        busy = sum(seconds for _, seconds in timings)
+        slowest = max(seconds for _, seconds in timings)
+        t_serial = t if t_serial is None else t_serial
+        print('{} processes: {:.2f} s ({:.1f}x), {} tiles, slowest tile '
+              '{:.2f} s, {:.1f} cores busy'.format(
+                  n, t, t_serial / t, len(timings), slowest,
+                  busy / t))
+
+
+def benchmark_resampling(im=None, spacing=(1, 1, 3)):
+    """Prints time and peak memory of resampling a bool volume with
+    anisotropic voxels to cubic ones, with skimage.transform.resize and
+    with resample_binary (bool and bit-packed output)."""
+    from skimage import transform
+    if im is None:
+        im = synthetic_volume((256, 256, 96))
+    output_shape = tuple(int(round(n * s)) for n, s in zip(im.shape, spacing))
+    print('volume: {} -> {}'.format(im.shape, output_shape))
+    ref, t, peak = peak_memory(transform.resize, im, output_shape)
+    print('transform.resize: {:.2f} s, peak {:.0f} MB, {}'.format(
+        t, peak / 2 ** 20, ref.dtype))
+    for packed in (False, True):
+        out, t, peak = peak_memory(resample_binary, im, output_shape,
+                                   packed=packed)
+        agree = np.mean(np.asarray(out) == (ref > 0.5))
+        print('resample_binary{}: {:.2f} s, peak {:.0f} MB, {:.4f} of '
+              'voxels agree'.format(' (packed)' if packed else '', t,
+                                    peak / 2 ** 20, agree))
+
+
+def benchmark_thinning(im=None, workers=(1, 2, 4, 8)):
+    """Prints the time of skeletonize_3d and of thinning.thin per thread
+    count, with the voxels, 26-connected components and Euler number of
+    each skeleton (the input's for reference).
+
+    On the example stack thin keeps the 33 components and Euler number
+    -872 of the input, while skeletonize_3d drops four small components
+    on the volume border (29 components, Euler number -876); see
+    thinning.py.
+    """
+    from skimage.measure import euler_number, label
+    if im is None:
+        im = synthetic_volume((192, 192, 192))
+
+    def topology(skel):
+        return '{} voxels, {} components, Euler number {}'.format(
+            int(skel.sum()), label(skel, connectivity=3).max(),
+            euler_number(skel, 3))
+
+    print('volume: {}, {} components, Euler number {}'.format(
+        im.shape, label(im, connectivity=3).max(), euler_number(im, 3)))
+    ref, t_ref = time_call(skeletonize, im)
+    print('skeletonize_3d: {:.2f} s, {}'.format(t_ref, topology(ref)))
+    for n in workers:
+        skel, t = time_call(thin, im, n)
+        print('thin, {} threads: {:.2f} s ({:.1f}x), {}, {} voxels differ'
+              .format(n, t, t_ref / t, topology(skel),
+                      int((skel != ref).sum())))
+
+
+# Modules that must not be imported by the core package at startup.
+HEAVY_MODULES = ('scipy', 'skimage', 'matplotlib', 'PyQt5', 'vtk')
+
+
+def import_time(module):
+    """Returns (seconds, heavy) for importing module in a fresh
+    interpreter: the import wall time and the HEAVY_MODULES it loaded."""
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            'import {}\n'
+            'print(time.perf_counter() - start)\n'
+            'print(" ".join(m for m in {!r} if m in sys.modules))'
+            .format(module, HEAVY_MODULES))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', code], cwd=root, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    seconds, heavy = (out.stdout.splitlines() + [''])[:2]
+    return float(seconds), heavy.split()
+
+
+def benchmark_import_time(modules=('aquami3D.inout', 'aquami3D.measure',
+                                   'aquami3D.cli'), budget=1.0, repeat=3):
+    """Cold-start import of the core modules.  Raises AssertionError if one
+    takes longer than budget seconds (best of repeat) or loads a heavy
+    module."""
+    for module in modules:
+        runs = [import_time(module) for _ in range(repeat)]
+        seconds = min(t for t, _ in runs)
+        heavy = runs[0][1]
+        print('import {}: {:.3f} s{}'.format(
+            module, seconds,
+            ', loads ' + ', '.join(heavy) if heavy else ''))
+        assert seconds <= budget, \
+            'import {} took {:.2f} s'.format(module, seconds)
+        assert not heavy, 'import {} loads {}'.format(module, heavy)
+
+
+if __name__ == '__main__':
+    benchmark_import_time()
+    benchmark_xyz_parsing(*sys.argv[1:2])
+    benchmark_parallel_xyz(*sys.argv[1:2])
+    benchmark_tiled_measurement()
+    benchmark_resampling()
+    benchmark_thinning()
+    if example_volume() is not None:
+        benchmark_thinning(example_volume(), workers=(1, 4))
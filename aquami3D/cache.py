@@ -0,0 +1,140 @@
+"""On-disk cache of converted boolean volumes.
+
+A cached volume lives next to its source as '<source>.<digest>.aqc', where
+the digest covers the conversion parameters, or in a cache directory
+(for read-only sources) with the source path in the digest as well.  The
+file holds a JSON header followed by the volume bit-packed along its last
+axis, so reopening it is a memory map instead of a parse.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .packed import PackedVolume
+
+MAGIC = b'AQUAMI3D-VOLUME\n'
+VERSION = 1
+# Header size; keeps the packed data page aligned for memory mapping.
+HEADER_SIZE = 4096
+# Bytes hashed from the start, middle and end of the source.
+SAMPLE_SIZE = 1024 * 1024
+
+
+def source_key(file_path, full_hash=False):
+    """Returns the size, mtime and content hash that identify a source.
+
+    By default the hash covers the size plus a sample from the start,
+    middle and end of the file, which catches rewritten dumps without
+    reading multi-gigabyte files in full.
+    """
+    stat = os.stat(file_path)
+    digest = hashlib.sha1(str(stat.st_size).encode())
+    with open(file_path, 'rb') as f:
+        if full_hash or stat.st_size <= 3 * SAMPLE_SIZE:
+            for block in iter(lambda: f.read(SAMPLE_SIZE), b''):
+                digest.update(block)
+        else:
+            for offset in (0, (stat.st_size - SAMPLE_SIZE) // 2,
+                           stat.st_size - SAMPLE_SIZE):
+                f.seek(offset)
+                digest.update(f.read(SAMPLE_SIZE))
+    return {'size': stat.st_size, 'mtime': stat.st_mtime,
+            'hash': digest.hexdigest()}
+
+
+def _normalize(params):
+    # Round trip through JSON so tuples compare equal to stored lists.
+    return json.loads(json.dumps(params, sort_keys=True))
+
+
+def cache_path(file_path, params, cache_dir=None):
+    text = json.dumps(params, sort_keys=True)
+    if cache_dir is not None:
+        text += os.path.abspath(file_path)
+    digest = hashlib.sha1(text.encode()).hexdigest()[:12]
+    if cache_dir is None:
+        return '{}.{}.aqc'.format(file_path, digest)
+    return os.path.join(cache_dir, '{}.{}.aqc'.format(
+        os.path.basename(file_path), digest))
+
+
+def cache_writable(file_path, cache_dir=None):
+    """Returns whether the cache of file_path can be written."""
+    directory = cache_dir if cache_dir is not None else \
+        os.path.dirname(os.path.abspath(file_path))
+    return os.access(directory, os.W_OK)
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a volume cache'.format(path))
+        return json.loads(f.read(HEADER_SIZE - len(MAGIC)).rstrip(b'\0 '))
+
+
+def load_cached_volume(file_path, params, packed=False, cache_dir=None):
+    """Returns the cached volume of file_path, or None if it is stale.
+
+    The packed bits are memory-mapped, so only the unpacking costs time.
+    With packed=True the memory map is returned as a PackedVolume and
+    nothing is read until it is sliced.
+    """
+    path = cache_path(file_path, params, cache_dir)
+    params = _normalize(params)
+    if not os.path.exists(path):
+        return None
+    try:
+        header = read_header(path)
+    except (OSError, ValueError):
+        return None
+    if (header.get('version') != VERSION or header.get('params') != params
+            or header.get('source') != source_key(file_path)):
+        return None
+    bits = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER_SIZE,
+                     shape=tuple(header['packed_shape']))
+    volume = PackedVolume(bits, header['shape'])
+    return volume if packed else np.asarray(volume)
+
+
+def save_cached_volume(file_path, params, volume, cache_dir=None):
+    """Writes volume to the cache of file_path.
+
+    Returns the cache path, or None if it could not be written (for
+    example next to a read-only source).
+    """
+    path = cache_path(file_path, params, cache_dir)
+    packed = PackedVolume.pack(volume).packed
+    header = {'version': VERSION, 'params': _normalize(params),
+              'source': source_key(file_path),
+              'shape': list(volume.shape),
+              'packed_shape': list(packed.shape)}
+    header = MAGIC + json.dumps(header, sort_keys=True).encode()
+    if len(header) > HEADER_SIZE:
+        raise ValueError('cache header is too large')
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(header.ljust(HEADER_SIZE, b'\0'))
+            packed.tofile(f)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None
+    return path
+
+
+def cached_volume(file_path, params, loader, packed=False, cache_dir=None):
+    """Returns the cached volume, or loads it with loader() and caches it.
+
+    cache_dir is the cache directory, None for next to the source.
+    """
+    volume = load_cached_volume(file_path, params, packed, cache_dir)
+    if volume is None:
+        volume = loader()
+        save_cached_volume(file_path, params, volume, cache_dir)
+        if packed:
+            volume = PackedVolume.pack(volume)
+    return volume
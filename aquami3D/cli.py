@@ -0,0 +1,292 @@
+"""Headless batch measurement: the aquami3d command.
+
+    aquami3d "tomograms/*.tif" --pixel-size 5 5 15 -o results -f csv -j 4
+
+Every input (TIFF stack or XYZ file; glob patterns are expanded) is
+measured by VolumeData and exported next to it or into --output-dir.
+Files are measured concurrently in a process pool.  TIFF stacks are
+opened lazily (see tiff.TiffVolume) and read by the measurement itself.
+With --cache (or --cache-dir) a prefetch thread voxelizes the next XYZ
+input into the volume cache (see cache.py) while the current ones are
+measured, and the workers open it memory-mapped.  Inputs whose cache
+cannot be written (read-only directories) are loaded by their worker
+instead.  Nothing here imports Qt, VTK or matplotlib.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import cache_writable
+from .inout import is_tiff, load_volume, open_tiff_stack
+from .measure import VolumeData, pixel_spacing
+from .sharedmem import process_pool
+
+# Export formats, by file extension (see VolumeData.export).
+FORMATS = ('txt', 'csv', 'npz')
+
+
+def expand_inputs(patterns):
+    """Returns the files named by patterns, expanding globs in order;
+    a pattern that matches nothing raises ValueError."""
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern] if os.path.isfile(pattern) else []
+        if not matches:
+            raise ValueError('no input matches {}'.format(pattern))
+        paths.extend(m for m in matches if m not in paths)
+    return paths
+
+
+def output_path(path, output_dir, fmt):
+    # <output_dir or input dir>/<input name>.<fmt>
+    stem = os.path.splitext(os.path.basename(path))[0]
+    directory = os.path.dirname(path) if output_dir is None else output_dir
+    return os.path.join(directory, '{}.{}'.format(stem, fmt))
+
+
+def make_jobs(args):
+    """Returns one job dict per input: the input, its outputs and the
+    VolumeData settings.  Inputs whose outputs would overwrite each other
+    (same name in one directory) raise ValueError."""
+    if len(args.pixel_size) == 1:
+        pixel_size, spacing = args.pixel_size[0], None
+    elif len(args.pixel_size) == 3:
+        pixel_size, spacing = pixel_spacing(*args.pixel_size)
+    else:
+        raise ValueError('--pixel-size takes 1 or 3 values')
+    jobs = []
+    for path in expand_inputs(args.inputs):
+        jobs.append({
+            'path': path,
+            'output': output_path(path, args.output_dir, args.format),
+            'project': output_path(path, args.output_dir, 'aqp')
+            if args.project else None,
+            'pixel_size': pixel_size,
+            'spacing': spacing,
+            'thinning': args.thinning,
+            'distance_precision': args.precision,
+            'tile_shape': tuple(args.tile) if args.tile else None,
+            'processes': args.tile_processes,
+            'invert': args.invert,
+            'load': {'use_cache': args.cache or args.cache_dir is not None,
+                     'frame': args.frame,
+                     'voxel_size': args.voxel_size,
+                     'atom_radius': args.atom_radius,
+                     'min_count': args.min_count, 'packed': True,
+                     'processes': args.load_processes,
+                     'cache_dir': args.cache_dir},
+            'verbose': args.verbose})
+    check_outputs(jobs)
+    return jobs
+
+
+def check_outputs(jobs):
+    # Raises ValueError if two jobs write the same file.
+    owners = {}
+    for job in jobs:
+        for path in (job['output'], job['project']):
+            if path is None:
+                continue
+            key = os.path.normcase(os.path.abspath(path))
+            if key in owners:
+                raise ValueError('{} and {} both write {}; use separate '
+                                 'output directories'.format(
+                                     owners[key], job['path'], path))
+            owners[key] = job['path']
+
+
+def load_job(job):
+    # The volume of a job: a lazy TiffVolume, or the voxelized (and with
+    # use_cache, cached) XYZ file.
+    if is_tiff(job['path']):
+        return open_tiff_stack(job['path'])
+    return load_volume(job['path'], **job['load'])
+
+
+def measure_job(job):
+    """Measures one input and writes its outputs.  Returns a summary dict;
+    errors are reported in it instead of raised."""
+    start = time.perf_counter()
+    summary = {'path': job['path'], 'output': job['output']}
+    volume = None
+    try:
+        volume = load_job(job)
+        data = VolumeData(volume, job['pixel_size'], invert_im=job['invert'],
+                          spacing=job['spacing'],
+                          distance_precision=job['distance_precision'],
+                          thinning=job['thinning'])
+        if not job['verbose']:
+            data.listener = lambda message, value: None
+        data.calculate(job['tile_shape'], processes=job['processes'])
+        data.export(job['output'])
+        if job['project'] is not None:
+            from .project import save_project
+            data.source = job['path']
+            save_project(job['project'], data)
+        summary.update(ligaments=len(data.lengths),
+                       diameters=len(data.all_diameters))
+    except Exception as e:
+        summary['error'] = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        if hasattr(volume, 'close'): # TiffVolume
+            volume.close()
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def run_jobs(jobs, processes=1):
+    """Yields the summary of every job, in order.
+
+    A prefetch thread loads the input of the next job into the volume
+    cache while the current ones are measured, and each job starts (in
+    the pool, or here with processes 1) once its input is cached and, in
+    the pool, a worker is free.  Jobs without the cache, or whose cache
+    cannot be written, load their own input.
+    """
+    with ThreadPoolExecutor(1) as prefetcher:
+
+        def prefetch(i):
+            # warms the volume cache for jobs[i]
+            if i < len(jobs) and prefetches(jobs[i]):
+                return prefetcher.submit(_prefetch, jobs[i])
+            return None
+
+        load = prefetch(0)
+        if processes == 1:
+            for i, job in enumerate(jobs):
+                if load is not None:
+                    load.result()
+                load = prefetch(i + 1)
+                yield measure_job(job)
+            return
+        workers = processes or os.cpu_count() or 1
+        with process_pool(processes) as pool:
+            results = []
+            for i, job in enumerate(jobs):
+                if load is not None:
+                    load.result()
+                while len(results) >= workers:
+                    yield results.pop(0).get()
+                results.append(pool.apply_async(measure_job, (job,)))
+                load = prefetch(i + 1)
+                # summaries are handed out as soon as they are in order
+                while results and results[0].ready():
+                    yield results.pop(0).get()
+            for result in results:
+                yield result.get()
+
+
+def prefetches(job):
+    # Prefetching only helps if the loaded volume is kept in the cache;
+    # TIFF stacks are read lazily instead.
+    load = job['load']
+    return (load['use_cache'] and not is_tiff(job['path'])
+            and cache_writable(job['path'], load['cache_dir']))
+
+
+def _prefetch(job):
+    try:
+        load_job(job)
+    except Exception:
+        pass # measure_job loads again and reports the error
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='aquami3d',
+        description='Measure ligament diameters and lengths of 3D volumes '
+                    '(TIFF stacks or XYZ files).')
+    parser.add_argument('inputs', nargs='+',
+                        help='input files or glob patterns')
+    parser.add_argument('-p', '--pixel-size', type=float, nargs='+',
+                        default=[1.0], metavar='SIZE',
+                        help='voxel size, or X Y Z sizes (default 1)')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='directory of the results (default: next to '
+                             'each input)')
+    parser.add_argument('-f', '--format', choices=FORMATS, default='txt',
+                        help='result format (default txt)')
+    parser.add_argument('--project', action='store_true',
+                        help='also save a project file (.aqp) per input')
+    parser.add_argument('-j', '--processes', type=int, default=1,
+                        help='inputs measured at once (0 for one per CPU)')
+    parser.add_argument('--tile', type=int, nargs=3, default=None,
+                        metavar=('X', 'Y', 'Z'),
+                        help='measure tile by tile with this tile shape')
+    parser.add_argument('--tile-processes', type=int, default=1,
+                        help='processes per input for tiles (only with -j 1)')
+    parser.add_argument('--load-processes', type=int, default=1,
+                        help='processes parsing each XYZ input, 0 for one '
+                             'per CPU (only with -j 1)')
+    parser.add_argument('--thinning', choices=('skimage', 'parallel'),
+                        default='skimage', help='skeletonization method')
+    parser.add_argument('--precision', choices=('float64', 'float32',
+                                                'uint16'),
+                        default='float64',
+                        help='dtype of the distance transform')
+    parser.add_argument('--invert', action='store_true',
+                        help='measure the dark phase')
+    parser.add_argument('--cache', action='store_true',
+                        help='cache voxelized XYZ inputs next to them and '
+                             'prefetch the next one')
+    parser.add_argument('--cache-dir', default=None,
+                        help='cache voxelized XYZ inputs in this directory '
+                             '(implies --cache)')
+    parser.add_argument('--frame', type=int, default=None,
+                        help='frame of multi-frame XYZ files')
+    parser.add_argument('--voxel-size', type=float, default=None,
+                        help='XYZ voxel size (see voxelize.Voxelizer)')
+    parser.add_argument('--atom-radius', type=float, default=None,
+                        help='XYZ atom radius (see voxelize.Voxelizer)')
+    parser.add_argument('--min-count', type=int, default=1,
+                        help='XYZ atoms per filled voxel')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print the stages of every measurement')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        jobs = make_jobs(args)
+    except ValueError as e:
+        print('aquami3d: {}'.format(e), file=sys.stderr)
+        return 2
+    for directory in (args.output_dir, args.cache_dir):
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+    uncached = sum(not prefetches(job) for job in jobs
+                   if job['load']['use_cache'] and not is_tiff(job['path']))
+    if uncached:
+        print('aquami3d: the volume cache of {} input(s) is not writable, '
+              'they are loaded without prefetch (see --cache-dir)'.format(
+                  uncached), file=sys.stderr)
+    processes = None if args.processes == 0 else args.processes
+    for job in jobs:
+        if job['load']['processes'] == 0:
+            job['load']['processes'] = None
+        if processes != 1:
+            # pool workers cannot start pools of their own
+            job['processes'] = 1
+            job['load']['processes'] = 1
+    failed = 0
+    for done, summary in enumerate(run_jobs(jobs, processes), 1):
+        if 'error' in summary:
+            failed += 1
+            status = 'failed: {}'.format(summary['error'])
+        else:
+            status = '{} ligaments, {} diameters -> {}'.format(
+                summary['ligaments'], summary['diameters'], summary['output'])
+        print('[{}/{}] {} ({:.1f} s) {}'.format(
+            done, len(jobs), summary['path'], summary['seconds'], status))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
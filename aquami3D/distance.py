@@ -0,0 +1,121 @@
+"""Distance transform of a volume in a selectable precision.
+
+A float64 distance_transform_edt of the whole volume is, with the index
+arrays the EDT allocates internally, the largest allocation of a
+measurement.  distance_field computes it slab by slab along the first
+axis and stores it as float64, float32 or uint16 squared distances,
+optionally in a disk_array so the field itself is paged out as well.
+"""
+import tempfile
+
+import numpy as np
+
+# Precisions of distance_field.
+PRECISIONS = ('float64', 'float32', 'uint16')
+# Voxels per slab of distance_field when slab is None; the EDT allocates
+# about 60 bytes per voxel of a block.
+SLAB_VOXELS = 1 << 22
+# Largest squared distance of a SquaredDistance.
+_MAX_SQUARED = np.iinfo(np.uint16).max
+
+
+class SquaredDistance(object):
+    """Distance field stored as uint16 squared distances.
+
+    squared holds round(d^2 * scale), so with cubic voxels (scale 1) the
+    distances are exact up to 255 voxels.  Indexing and np.asarray return
+    float32 distances.
+    """
+
+    def __init__(self, squared, scale=1.0):
+        self.squared = squared
+        self.scale = float(scale)
+        self.shape = squared.shape
+        self.ndim = squared.ndim
+        self.dtype = np.dtype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.squared.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self._distance(self.squared[key])
+
+    def __array__(self, dtype=None, copy=None):
+        data = self._distance(self.squared)
+        return data if dtype is None else data.astype(dtype)
+
+    def _distance(self, squared):
+        squared = np.asarray(squared, dtype=np.float32)
+        if self.scale != 1:
+            squared /= self.scale
+        return np.sqrt(squared)
+
+    def max(self):
+        return float(self._distance(self.squared.max())) if self.squared.size \
+            else 0.0
+
+
+def disk_array(shape, dtype):
+    """Returns a zeroed array memory-mapped from an anonymous temporary
+    file, which the OS pages to disk instead of keeping it in memory."""
+    with tempfile.TemporaryFile() as f:
+        return np.memmap(f, dtype, 'w+', shape=tuple(shape))
+
+
+def distance_field(im, spacing=None, precision='float64', slab=None,
+                   halo=16, out=None, progress=None):
+    """Returns the Euclidean distance transform of im.
+
+    spacing is the voxel size along each axis.  precision is 'float64' (as
+    distance_transform_edt), 'float32', or 'uint16' for a SquaredDistance
+    whose scale makes the finest voxel size 1; distances it cannot hold
+    raise ValueError.  The field is computed slab voxels at a time along
+    the first axis (by default about SLAB_VOXELS, and at least twice the
+    halo), each with a halo of halo voxels that is grown until it holds
+    the nearest background of every voxel in the slab, so the result
+    equals the whole-volume transform.  im may be any volume that returns
+    bool arrays when sliced.  out is an array of im.shape and dtype
+    precision to write to, e.g. a disk_array.  progress(done, total) is
+    called after every slab.
+    """
+    from scipy import ndimage
+    if precision not in PRECISIONS:
+        raise ValueError('unknown precision: {}'.format(precision))
+    shape = tuple(im.shape)
+    step = 1.0 if spacing is None else float(spacing[0])
+    if precision == 'uint16':
+        scale = 1.0 if spacing is None else 1.0 / min(spacing) ** 2
+    if out is None:
+        out = np.empty(shape, dtype=precision)
+    if slab is None:
+        plane = max(int(np.prod(shape[1:])), 1)
+        slab = max(SLAB_VOXELS // plane, 2 * halo)
+    for start in range(0, shape[0], slab):
+        stop = min(start + slab, shape[0])
+        while True:
+            lo, hi = max(start - halo, 0), min(stop + halo, shape[0])
+            block = np.asarray(im[lo:hi], dtype='bool')
+            dt = ndimage.distance_transform_edt(block, sampling=spacing)
+            dt = dt[start - lo:stop - lo]
+            whole = lo == 0 and hi == shape[0]
+            reach = float(dt.max()) if dt.size else 0.0
+            # a background voxel in the block within the halo of every
+            # slab voxel makes the block distances exact
+            if whole or (not block.all() and reach <= halo * step):
+                break
+            halo = max(int(np.ceil(reach / step)) + 1, 2 * halo)
+        if precision == 'uint16':
+            squared = np.rint(dt ** 2 * scale)
+            if squared.size and squared.max() > _MAX_SQUARED:
+                raise ValueError("distances too large for precision "
+                                 "'uint16', use 'float32'")
+            out[start:stop] = squared
+        else:
+            out[start:stop] = dt
+        if progress is not None:
+            progress(stop, shape[0])
+    return SquaredDistance(out, scale) if precision == 'uint16' else out
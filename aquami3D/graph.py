@@ -0,0 +1,271 @@
+"""Compact graph of a skeleton: junctions, ligaments and their adjacency.
+
+The graph is built from the skeleton voxel list in one vectorized pass:
+voxel adjacency comes from a binary search of the sorted flat indices, and
+junction clusters and ligaments are connected components of that sparse
+adjacency.  Nothing volume-sized is allocated.
+"""
+import itertools
+
+import numpy as np
+
+from .packed import PackedVolume
+
+# The 13 neighbor offsets that come first in C order; with their negatives
+# they make up the 26-neighborhood.
+FORWARD_OFFSETS = np.array([o for o in itertools.product((-1, 0, 1), repeat=3)
+                            if o > (0, 0, 0)])
+
+
+def neighbor_pairs(coords, shape):
+    """Returns index pairs (i, j) of 26-adjacent voxels in a voxel list.
+
+    coords are (3, n) voxel coordinates, e.g. np.nonzero of a skeleton.
+    Every adjacent pair is returned once.  Neighbors are found by binary
+    search of the sorted flat indices, so nothing volume-sized is built.
+    """
+    coords = np.asarray(coords)
+    keys = np.ravel_multi_index(coords, shape)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    upper = np.array(shape)[:, None]
+    first, second = [], []
+    for offset in FORWARD_OFFSETS:
+        near = coords + offset[:, None]
+        i = np.flatnonzero(np.all((near >= 0) & (near < upper), axis=0))
+        if not len(keys) or not len(i):
+            continue
+        near = np.ravel_multi_index(near[:, i], shape)
+        pos = np.minimum(np.searchsorted(keys, near), len(keys) - 1)
+        found = keys[pos] == near
+        first.append(i[found])
+        second.append(order[pos[found]])
+    if not first:
+        return np.zeros(0, np.intp), np.zeros(0, np.intp)
+    return np.concatenate(first), np.concatenate(second)
+
+
+def skeleton_degrees(coords, shape, pairs=None):
+    """Returns the number of 26-neighbors of every voxel in a voxel list.
+
+    Integer counts from neighbor_pairs (or the given pairs); the cost
+    grows with the number of voxels, not the volume.
+    """
+    i, j = neighbor_pairs(coords, shape) if pairs is None else pairs
+    n = len(coords[0])
+    degrees = np.bincount(i, minlength=n) + np.bincount(j, minlength=n)
+    return degrees.astype(np.uint8)
+
+
+def _components(n, i, j):
+    # Connected component of each of n vertices joined by the pairs (i, j).
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)),
+                       shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+
+def _number(component, members):
+    # Ids of the components of the member voxels, numbered by first
+    # appearance (C order, like skimage.measure.label); -1 elsewhere.
+    ids = np.full(len(component), -1, dtype=np.intp)
+    unique, first = np.unique(component[members], return_index=True)
+    renumber = np.zeros(component.max() + 1 if len(component) else 0,
+                        dtype=np.intp)
+    renumber[unique[np.argsort(first)]] = np.arange(len(unique))
+    ids[members] = renumber[component[members]]
+    return ids, len(unique)
+
+
+def _csr(ids, n):
+    # Returns (ptr, members): the indices with id k are
+    # members[ptr[k]:ptr[k + 1]], in increasing order.
+    inside = np.flatnonzero(ids >= 0)
+    members = inside[np.argsort(ids[inside], kind='stable')]
+    ptr = np.zeros(n + 1, dtype=np.intp)
+    np.cumsum(np.bincount(ids[inside], minlength=n), out=ptr[1:])
+    return ptr, members
+
+
+class SkeletonGraph(object):
+    """Junctions and ligaments of a skeleton.
+
+    coords are the (3, n) skeleton voxels in C order and degrees their
+    26-neighbor counts; dt optionally holds the distance transform at every
+    voxel.  Voxels with more than two neighbors form junction clusters
+    (nodes), the rest with at least one neighbor form ligaments (edges).
+
+    Node table: node_ptr/node_voxels list the voxels of each node,
+    node_size, node_centroid and node_degree (number of ligaments that
+    touch it).  Edge table: edge_ptr/edge_voxels list the voxel path of
+    each ligament, edge_nodes holds the first two bounding nodes (-1 for a
+    free end) and terminal marks ligaments with a free end voxel.
+    voxel_node and voxel_edge map voxels to their node or edge (-1 for
+    none).  indptr/indices/edge_ids are the CSR adjacency between nodes:
+    the neighbors of node k are indices[indptr[k]:indptr[k + 1]], joined by
+    the ligaments edge_ids of the same slice.  Nodes and edges are numbered
+    in C order of their first voxel, like a labelling of the volume.
+    """
+
+    def __init__(self, shape, coords, degrees=None, dt=None, pairs=None):
+        self.shape = tuple(int(i) for i in shape)
+        self.coords = np.asarray(coords)
+        self.dt = dt
+        n = self.coords.shape[1]
+        if pairs is None:
+            pairs = neighbor_pairs(self.coords, self.shape)
+        if degrees is None:
+            degrees = skeleton_degrees(self.coords, self.shape, pairs)
+        self.degrees = degrees
+        self.pairs = pairs
+        i, j = pairs
+
+        junction = degrees > 2
+        ligament = (degrees > 0) & ~junction
+        same = junction[i] == junction[j]
+        component = _components(n, i[same], j[same])
+        self.voxel_node, self.n_nodes = _number(component, junction)
+        self.voxel_edge, self.n_edges = _number(component, ligament)
+
+        # node table
+        self.node_ptr, self.node_voxels = _csr(self.voxel_node, self.n_nodes)
+        self.node_size = np.diff(self.node_ptr)
+        nodes = self.voxel_node[junction]
+        self.node_centroid = np.stack(
+            [np.bincount(nodes, c[junction], self.n_nodes)
+             for c in self.coords], axis=1) / np.maximum(
+                 self.node_size, 1)[:, None]
+
+        # edge table
+        self.edge_ptr, self.edge_voxels = _csr(self.voxel_edge, self.n_edges)
+        self.edge_size = np.diff(self.edge_ptr)
+        ends = np.bincount(self.voxel_edge[degrees == 1],
+                           minlength=self.n_edges)
+        self.terminal = ends > 0
+
+        # ligament-junction contacts, one per (edge, node)
+        cross = ~same
+        a, b = i[cross], j[cross]
+        lig, jun = np.where(junction[a], b, a), np.where(junction[a], a, b)
+        link = np.unique(self.voxel_edge[lig] * max(self.n_nodes, 1)
+                         + self.voxel_node[jun])
+        self.link_edge = link // max(self.n_nodes, 1)
+        self.link_node = link % max(self.n_nodes, 1)
+        self.node_degree = np.bincount(self.link_node,
+                                       minlength=self.n_nodes)
+        count = np.bincount(self.link_edge, minlength=self.n_edges)
+        start = np.zeros(self.n_edges, dtype=np.intp)
+        start[1:] = np.cumsum(count)[:-1]
+        self.edge_nodes = np.full((self.n_edges, 2), -1, dtype=np.intp)
+        has = count > 0
+        self.edge_nodes[has, 0] = self.link_node[start[has]]
+        has = count > 1
+        self.edge_nodes[has, 1] = self.link_node[start[has] + 1]
+
+        # CSR adjacency between nodes, through ligaments with two ends
+        both = np.flatnonzero(count > 1)
+        u, v = self.edge_nodes[both, 0], self.edge_nodes[both, 1]
+        rows = np.concatenate([u, v])
+        order = np.argsort(rows, kind='stable')
+        self.indices = np.concatenate([v, u])[order]
+        self.edge_ids = np.concatenate([both, both])[order]
+        self.indptr = np.zeros(self.n_nodes + 1, dtype=np.intp)
+        np.cumsum(np.bincount(rows, minlength=self.n_nodes),
+                  out=self.indptr[1:])
+
+    def __len__(self):
+        return self.coords.shape[1]
+
+    def edge(self, k):
+        """Returns the voxel indices of ligament k."""
+        return self.edge_voxels[self.edge_ptr[k]:self.edge_ptr[k + 1]]
+
+    def node(self, k):
+        """Returns the voxel indices of junction k."""
+        return self.node_voxels[self.node_ptr[k]:self.node_ptr[k + 1]]
+
+    def neighbors(self, k):
+        """Returns (nodes, ligaments) adjacent to junction k."""
+        s = slice(self.indptr[k], self.indptr[k + 1])
+        return self.indices[s], self.edge_ids[s]
+
+    def edge_lengths(self, spacing=None):
+        """Returns the node-to-node length of every ligament in voxels, or
+        in the units of spacing (the voxel size along each axis) if given.
+
+        Steps along the voxel path weigh 1, sqrt(2) or sqrt(3) for face,
+        edge and corner neighbors.  Each end that touches a junction adds
+        the distance from the end voxel to the junction centroid, so
+        chained ligaments add up to the centroid-to-centroid path.  As
+        ligament voxels have at most two neighbors, the adjacent pairs
+        inside a ligament are exactly its path steps, and all ligaments
+        are summed in one bincount.
+        """
+        i, j = self.pairs
+        edge = self.voxel_edge
+        inside = (edge[i] >= 0) & (edge[i] == edge[j])
+        steps = self.coords[:, i[inside]] - self.coords[:, j[inside]]
+        scale = np.ones(3) if spacing is None else np.asarray(spacing,
+                                                              'float')
+        steps = steps * scale[:, None]
+        lengths = np.bincount(edge[i[inside]],
+                              np.sqrt((steps ** 2).sum(axis=0)),
+                              self.n_edges)
+        # ligament end voxel -> junction centroid
+        contact = (edge[i] >= 0) != (edge[j] >= 0)
+        contact &= (self.voxel_node[i] >= 0) | (self.voxel_node[j] >= 0)
+        a, b = i[contact], j[contact]
+        lig = np.where(edge[a] >= 0, a, b)
+        jun = np.where(edge[a] >= 0, b, a)
+        ends = self.coords[:, lig].T - self.node_centroid[self.voxel_node[jun]]
+        ends = ends * scale
+        lengths += np.bincount(edge[lig], np.sqrt((ends ** 2).sum(axis=1)),
+                               self.n_edges)
+        return lengths
+
+    def node_mask(self):
+        # Junction voxels, as find_nodes.
+        return self.voxel_node >= 0
+
+    def terminal_mask(self):
+        # Voxels of terminal ligaments.
+        on = self.voxel_edge >= 0
+        mask = np.zeros(len(self), dtype='bool')
+        mask[on] = self.terminal[self.voxel_edge[on]]
+        return mask
+
+    def connected_mask(self):
+        # The skeleton without terminal ligaments or isolated voxels.
+        return (self.degrees > 1) & ~self.terminal_mask()
+
+    def volume(self, selection=None, packed=True):
+        """Returns the selected voxels as a bool volume."""
+        coords = self.coords if selection is None else \
+            self.coords[:, selection]
+        if packed:
+            return PackedVolume.from_coords(self.shape, coords)
+        volume = np.zeros(self.shape, dtype='bool')
+        volume[tuple(coords)] = 1
+        return volume
+
+    @classmethod
+    def from_arrays(cls, shape, arrays, pairs):
+        """Rebuilds a graph from its saved attributes (see project.py)
+        without recomputing anything."""
+        graph = cls.__new__(cls)
+        graph.shape = tuple(int(i) for i in shape)
+        graph.pairs = pairs
+        for name, value in arrays.items():
+            setattr(graph, name, value)
+        graph.n_nodes = len(graph.node_size)
+        graph.n_edges = len(graph.edge_size)
+        return graph
+
+    @classmethod
+    def from_volume(cls, skel, dt=None):
+        """Builds the graph of a bool skeleton volume (or PackedVolume),
+        sampling the distance transform dt at the skeleton if given."""
+        coords = np.array(skel.nonzero())
+        samples = None if dt is None else dt[tuple(coords)]
+        return cls(skel.shape, coords, dt=samples)
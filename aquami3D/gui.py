@@ -1,27 +1,66 @@
 # -*- coding: utf-8 -*-
+# Run with: python -m aquami3D.gui
 import sys
 from threading import Thread
 from pathlib import Path
 import time
 
 
-import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
-from scipy.stats import lognorm, norm
-
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.Qt import QMainWindow, QApplication
 
-from visualization import VtkWindow, Plot, PlotCanvas
-from inout import *
-from measure import *
-from qslider import QSliceRange
+from .visualization import VtkWindow, Plot, PlotCanvas
+from .inout import open_tiff_stack, load_volume
+from .measure import VolumeData, CalculationCancelled, pixel_spacing
+from .project import save_project, load_project
+from .distance import distance_field
+from .qslider import QSliceRange
+
+
+class CalculateWorker(QThread):
+    """Runs VolumeData.calculate off the GUI thread.
+
+    Progress arrives through the progressed signal (throttled by the
+    VolumeData); exactly one of succeeded, cancelled or failed is emitted
+    at the end.
+    """
+    progressed = pyqtSignal(str, int)
+    succeeded = pyqtSignal()
+    cancelled = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, volume_data, parent=None):
+        QThread.__init__(self, parent)
+        self.volume_data = volume_data
+        # a cancel() can now only come from this calculation, even before
+        # the thread starts
+        volume_data.reset_cancel()
+
+    def run(self):
+        self.volume_data.listener = self.progressed.emit
+        try:
+            # keeps the tiling of a reopened project, whose skeleton is
+            # then reused
+            data = self.volume_data
+            data.calculate(data.tile_shape, data.halo)
+        except CalculationCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit()
+        finally:
+            self.volume_data.listener = None
+
+    def cancel(self):
+        self.volume_data.cancel()
 
 
 class MainWindow(QMainWindow):
     volume_data = None
+    worker = None
 
     def __init__(self, parent = None):
         QMainWindow.__init__(self)
@@ -52,10 +91,16 @@ class MainWindow(QMainWindow):
         load_button.clicked.connect(self.load_click)
         self.menuGrid.addWidget(load_button, 0,0)
 
-        calc_button = QPushButton("Calculate", self)
-        calc_button.setToolTip('Skeletonize image')
-        calc_button.clicked.connect(self.calculate)
-        self.menuGrid.addWidget(calc_button, 1, 0)
+        self.calc_button = QPushButton("Calculate", self)
+        self.calc_button.setToolTip('Skeletonize image')
+        self.calc_button.clicked.connect(self.calculate)
+        self.menuGrid.addWidget(self.calc_button, 1, 0)
+
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.setToolTip('Stop the calculation')
+        self.cancel_button.clicked.connect(self.cancel_clicked)
+        self.cancel_button.setEnabled(False)
+        self.menuGrid.addWidget(self.cancel_button, 3, 0)
 
         self.save_button = QPushButton('Save data', self)
         self.save_button.setToolTip('Save all measurements')
@@ -63,6 +108,18 @@ class MainWindow(QMainWindow):
         self.save_button.setEnabled(False)
         self.menuGrid.addWidget(self.save_button, 2,0)
 
+        open_project_button = QPushButton('Open project', self)
+        open_project_button.setToolTip('Open a saved project')
+        open_project_button.clicked.connect(self.open_project_clicked)
+        self.menuGrid.addWidget(open_project_button, 7, 0)
+
+        self.save_project_button = QPushButton('Save project', self)
+        self.save_project_button.setToolTip(
+            'Save the volume and every computed result')
+        self.save_project_button.clicked.connect(self.save_project_clicked)
+        self.save_project_button.setEnabled(False)
+        self.menuGrid.addWidget(self.save_project_button, 8, 0)
+
         # Pixel size
         lblPixelSize = QLabel('Pixel Size:')
         lblXPixelSize = QLabel('X:')
@@ -115,13 +172,15 @@ class MainWindow(QMainWindow):
 
     @pyqtSlot()
     def load_click(self):
+        if self.worker is not None: # calculating
+            return
         path, _ = QFileDialog.getOpenFileName(self,"Select 3D image")
         if path == '':
             return
-        try: #tiff stack
-            im = read_tiff_stack(path)
-        except OSError: #xyz file
-            im = read_xyz(path)
+        try: #tiff stack, only the cropped region is read
+            im = open_tiff_stack(path)
+        except OSError: #xyz file, parsed on every CPU and cached
+            im = load_volume(path, packed=True, processes=None)
         im = im[:150, :150, :150]
         #im = im[:100, :100, :100]
 
@@ -129,15 +188,19 @@ class MainWindow(QMainWindow):
             xsize = float(self.txtXPixelSize.text())
             ysize = float(self.txtYPixelSize.text())
             zsize = float(self.txtZPixelSize.text())
-            im, pixel_size = resize_and_get_pixel_size(im, xsize,ysize,zsize)
+            # measured on the original voxels, nothing is resampled
+            pixel_size, spacing = pixel_spacing(xsize, ysize, zsize)
         except:
             print('Size values not entered correctly.\n'
                   'No scaling and pixel size is 1.')
-            pixel_size = 1
+            pixel_size, spacing = 1, None
         self.sliceRange.set_range_maximums(im.shape)
 
-        self.volume_data = VolumeData(im, pixel_size, self.statusLabel, self.progress,
-                                      self.display, self.plot, invert_im=False)
+        # progress comes from the calculate worker, see calculate()
+        self.volume_data = VolumeData(im, pixel_size, invert_im=False,
+                                      spacing=spacing)
+        self.volume_data.source = path
+        self.save_project_button.setEnabled(True)
         self.vtk.update2(self.volume_data.im, (0.05, 0.5))
         try:
             self.sliceRange.valueChanged.disconnect()
@@ -150,18 +213,107 @@ class MainWindow(QMainWindow):
         if self.volume_data is None:
             QMessageBox.warning(self, "Warning", "Please load an image first",
                                 QMessageBox.Ok)
-        else:
-            self.volume_data.calculate()
+        elif self.worker is None:
+            self.worker = CalculateWorker(self.volume_data, self)
+            self.worker.progressed.connect(self.show_progress)
+            self.worker.succeeded.connect(self.calculation_succeeded)
+            self.worker.cancelled.connect(self.calculation_cancelled)
+            self.worker.failed.connect(self.calculation_failed)
+            self.worker.finished.connect(self.calculation_finished)
+            self.calc_button.setEnabled(False)
+            self.cancel_button.setEnabled(True)
+            self.save_button.setEnabled(False)
+            self.progress.setValue(0)
+            self.progress.setVisible(True)
+            self.worker.start()
+
+    @pyqtSlot()
+    def cancel_clicked(self):
+        if self.worker is not None:
+            self.statusLabel.setText('Cancelling...')
+            self.cancel_button.setEnabled(False)
+            self.worker.cancel()
+
+    @pyqtSlot(str, int)
+    def show_progress(self, message, value):
+        self.statusLabel.setText(message)
+        self.progress.setValue(value)
+
+    @pyqtSlot()
+    def calculation_succeeded(self):
+        # The only render of a calculation.
+        shape = self.volume_data.shape
+        self.display([0, shape[0], 0, shape[1], 0, shape[2]])
+        self.plot.plot(self.volume_data.all_diameters, 'diameter [units]')
+        try:
             self.sliceRange.valueChanged.disconnect()
-            self.sliceRange.valueChanged.connect(self.display)
-            self.save_button.setEnabled(True)
+        except:
+            pass
+        self.sliceRange.valueChanged.connect(self.display)
+        self.save_button.setEnabled(True)
+
+    @pyqtSlot()
+    def calculation_cancelled(self):
+        self.statusLabel.setText('Calculation cancelled')
+
+    @pyqtSlot(str)
+    def calculation_failed(self, message):
+        QMessageBox.warning(self, "Warning",
+                            "Calculation failed: {}".format(message),
+                            QMessageBox.Ok)
+
+    @pyqtSlot()
+    def calculation_finished(self):
+        self.worker = None
+        self.progress.setVisible(False)
+        self.calc_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
 
     @pyqtSlot()
     def save_clicked(self):
-        path, _ = QFileDialog.getSaveFileName(self, "Save as...",
-                                              filter='*.txt')
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Save as...",
+            filter='Text (*.txt);;Compressed arrays (*.npz);;CSV (*.csv)')
+        if path == '':
+            return
         self.volume_data.export(path)
 
+    @pyqtSlot()
+    def save_project_clicked(self):
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Save project as...", filter='AQUAMI project (*.aqp)')
+        if path == '':
+            return
+        save_project(path, self.volume_data)
+
+    @pyqtSlot()
+    def open_project_clicked(self):
+        if self.worker is not None: # calculating
+            return
+        path, _ = QFileDialog.getOpenFileName(
+            self, "Open project", filter='AQUAMI project (*.aqp)')
+        if path == '':
+            return
+        # Nothing is recomputed; volumes are read as the view needs them.
+        self.volume_data = load_project(
+            path, status=self.statusLabel, progress=self.progress,
+            display=self.display, plot=self.plot)
+        self.sliceRange.set_range_maximums(self.volume_data.shape)
+        try:
+            self.sliceRange.valueChanged.disconnect()
+        except:
+            pass
+        if self.volume_data.all_diameters is not None:
+            self.sliceRange.valueChanged.connect(self.display)
+            self.save_button.setEnabled(True)
+            self.display([0, self.volume_data.shape[0],
+                          0, self.volume_data.shape[1],
+                          0, self.volume_data.shape[2]])
+        else:
+            self.sliceRange.valueChanged.connect(self.load_update)
+            self.vtk.update2(self.volume_data.im, (0.05, 0.5))
+        self.save_project_button.setEnabled(True)
+
 
     @pyqtSlot()
     def dist_click(self):
@@ -175,7 +327,7 @@ class MainWindow(QMainWindow):
             self.vtk.update2(self.dist, (0, 1))
 
     def start_dist(self):
-        self.calc_dist.emit(distance_transform(self.im))
+        self.calc_dist.emit(distance_field(self.im, precision='float32'))
 
 
     def finish_dist(self, dist):
@@ -1,60 +1,160 @@
+import json
+
 import numpy as np
-from skimage import io
-from skimage.morphology import binary_dilation
 
-def read_tiff_stack(file_path):
-    im = io.imread(file_path)
-    im = im > 0
-    im = np.swapaxes(im, 0, 2)
+from .xyz import (read_xyz_positions, read_xyz_positions_parallel,
+                  XYZTrajectory)
+from .voxelize import voxelize_xyz, voxelize_positions
+from .tiff import TiffVolume
+from .cache import cached_volume
+from .packed import PackedVolume
+
+def open_tiff_stack(file_path):
+    # Nothing is read until the volume is sliced.
+    return TiffVolume(file_path)
+
+def read_tiff_stack(file_path, packed=False):
+    # packed returns a PackedVolume, built 8 pages at a time.
+    with TiffVolume(file_path) as stack:
+        im = stack.pack() if packed else stack[:, :, :]
     return im
 
-def read_xyz(file_path):
-    import time # OVITO loads about 35% faster than this
-    t = time.time()
-
-    # puts the data in a numpy array really fast (25% slower than OVITO)
-    # https://stackoverflow.com/questions/8956832/python-out-of-memory-on-large-csv-file-numpy?utm_medium=organic&utm_source=google_rich_qa&utm_campaign=google_rich_qa
-    def iter_loadtxt(filename, delimiter=' ', skiprows=0, skipcols=0,
-                     dtype=float):
-        def iter_func():
-            with open(filename, 'r') as infile:
-                for _ in range(skiprows):
-                    next(infile)
-                for line in infile:
-                    line = line.rstrip().split(delimiter)[skipcols:skipcols+3]
-                    for item in line:
-                        yield dtype(item)
-            iter_loadtxt.rowlength = len(line)
-
-        data = np.fromiter(iter_func(), dtype=dtype)
-        data = data.reshape((-1, iter_loadtxt.rowlength))
-        return data
-
-    # Find the column start
-    with(open(file_path, 'r')) as f:
-        next(f) #skip first line.
-        meta = f.readline() # read the second line.
-        meta = meta.split('Properties=')[1] # get properties.
-        meta = meta.split('pos')[0] # get columns before pos.
-        meta = meta.split(':') # separate keys and values.
-        skipcols = sum([int(i) for i in meta[2::3]]) # add columns before pos.
-
-    data = iter_loadtxt(file_path, skiprows=2, skipcols=skipcols) # get data
-    data = data * 0.407 # scale lattice parameter to 1 pixel
-    data = np.rint(data).astype(int) # convert to integer
-    data = data - data.min(axis=0) # set minimum to 0 for all axes
-    volume = np.zeros(data.max(axis=0) + 1, dtype='bool') # create array
-    volume[data[:, 0], data[:, 1], data[:, 2]] = 1 # fill from coordinates
-    # each atom is more than just a point
-    volume = binary_dilation(volume, selem=np.ones((2, 2, 2)))
-    print(time.time()-t)
+def read_xyz(file_path, stream=False, use_cell=False, frame=None,
+             trajectory=None, voxel_size=None, atom_radius=None, min_count=1,
+             packed=False, processes=1):
+    # frame selects one frame of a multi-frame dump through its index.
+    # voxel_size, atom_radius and min_count control the voxelization, see
+    # voxelize.Voxelizer; by default every atom fills a 2x2x2 block of
+    # 1/0.407 sized voxels.  With processes other than 1 (None for one per
+    # CPU) the positions are parsed by a process pool instead of streamed.
+    header = end = None
+    if frame is not None:
+        if trajectory is None:
+            trajectory = XYZTrajectory(file_path)
+        header = trajectory.header(frame)
+        end = trajectory.end(frame)
+    if processes != 1:
+        data = read_xyz_positions_parallel(file_path, header, end, processes)
+        volume = voxelize_positions(data, voxel_size, atom_radius, min_count)
+    elif stream:
+        # quantize block by block, never holding all positions at once
+        volume = voxelize_xyz(file_path, voxel_size, atom_radius, min_count,
+                              use_cell=use_cell, header=header)
+    else:
+        data = read_xyz_positions(file_path, header) # get data
+        volume = voxelize_positions(data, voxel_size, atom_radius, min_count)
+    if packed:
+        volume = PackedVolume.pack(volume)
     return volume
 
 
+def iter_xyz_frames(file_path, frames=None, stream=True, use_cell=False,
+                    **voxelization):
+    # Yields (frame, volume) for an int, slice or list of frames.  Only the
+    # requested frames are parsed.
+    trajectory = XYZTrajectory(file_path)
+    for frame in trajectory.frames(frames):
+        yield frame, read_xyz(file_path, stream, use_cell, frame, trajectory,
+                              **voxelization)
+
+
+def is_tiff(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read(4) in (b'II*\0', b'MM\0*', b'II+\0', b'MM\0+')
+
+def load_volume(file_path, use_cache=True, stream=True, use_cell=False,
+                frame=None, voxel_size=None, atom_radius=None, min_count=1,
+                packed=False, processes=1, cache_dir=None):
+    # Reads a tiff stack or xyz file (or one frame of it).  The converted
+    # volume is cached next to the source (or in cache_dir), so reopening
+    # it skips parsing and voxelization.  With packed a PackedVolume over
+    # the memory-mapped cache is returned without unpacking anything.
+    # processes is passed to read_xyz.
+    if is_tiff(file_path):
+        params = {'format': 'tiff', 'threshold': 0}
+        loader = lambda: read_tiff_stack(file_path, packed)
+    else:
+        params = {'format': 'xyz', 'voxel_size': voxel_size,
+                  'atom_radius': atom_radius, 'min_count': min_count,
+                  'use_cell': use_cell}
+        if frame is not None:
+            params['frame'] = frame
+        loader = lambda: read_xyz(file_path, stream, use_cell, frame, None,
+                                  voxel_size, atom_radius, min_count, packed,
+                                  processes)
+    if not use_cache:
+        return loader()
+    return cached_volume(str(file_path), params, loader, packed, cache_dir)
+
+
 def save_measurements_to_text(file, title, list):
-    with open(file, 'wb') as f:
+    with open(file, 'w') as f:
         f.write(title)
-        f.write('\n'.join(list))
+        f.write('\n')
+        f.write('\n'.join([str(i) for i in list]))
+
+
+# Measurements written per block by write_measurements_csv.
+CSV_BLOCK = 65536
+
+
+def format_values(values, fmt='%r', sep='\n'):
+    # Formats a whole array with one string operation instead of one str()
+    # call per value.  '%r' of the python scalars matches str() of numpy's.
+    values = np.asarray(values).ravel().tolist()
+    return sep.join([fmt] * len(values)) % tuple(values)
+
+
+def save_measurements_npz(path, columns, metadata):
+    # Compressed .npz with one array per measurement and the metadata as a
+    # JSON string.
+    arrays = {name: np.asarray(values) for name, values in columns.items()}
+    arrays['metadata'] = np.array(json.dumps(metadata, sort_keys=True))
+    np.savez_compressed(path, **arrays)
+
+
+def write_measurements_csv(path, columns, metadata, block=CSV_BLOCK):
+    # Long format 'measurement,value' csv.  Values are formatted a block at
+    # a time with one string operation instead of one str() per value.  The
+    # column names are listed in the header, so empty columns survive.
+    with open(path, 'w') as f:
+        f.write('# {}\n'.format(json.dumps(metadata, sort_keys=True)))
+        f.write('# columns: {}\n'.format(','.join(columns)))
+        f.write('measurement,value\n')
+        for name, values in columns.items():
+            values = np.asarray(values, dtype=float).ravel()
+            for i in range(0, len(values), block):
+                f.write(format_values(values[i:i + block], name + ',%r'))
+                f.write('\n')
+
+
+def load_measurements(path):
+    # Reads a .npz or .csv export back into ({name: array}, metadata).
+    if str(path).endswith('.npz'):
+        with np.load(path) as data:
+            metadata = json.loads(str(data['metadata']))
+            columns = {k: data[k] for k in data.files if k != 'metadata'}
+        return columns, metadata
+    metadata, names, skip = {}, [], 0
+    with open(path) as f:
+        for line in f:
+            skip += 1
+            if line.startswith('# columns:'):
+                names = [i for i in line[10:].strip().split(',') if i]
+            elif line.startswith('#'):
+                metadata = json.loads(line[1:])
+            else: # the 'measurement,value' line
+                break
+        has_rows = bool(f.readline().strip())
+    columns = dict((name, np.zeros(0)) for name in names)
+    if not has_rows:
+        return columns, metadata
+    rows = np.loadtxt(path, delimiter=',', skiprows=skip, ndmin=1,
+                      dtype=[('name', 'U64'), ('value', float)])
+    found, first_rows = np.unique(rows['name'], return_index=True)
+    for name in found[np.argsort(first_rows)]:
+        columns[str(name)] = rows['value'][rows['name'] == name]
+    return columns, metadata
 
 
 if __name__ == '__main__':
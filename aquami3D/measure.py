@@ -1,34 +1,69 @@
-import numpy as np
-import matplotlib.pyplot as plt
-from skimage import morphology, transform
-from skimage.measure import label
-from scipy import ndimage
-from scipy.signal import convolve
+import itertools
+import threading
+import time
 
+import numpy as np
 
-def resize_and_get_pixel_size(im, x_pixel_size, y_pixel_size, z_pixel_size):
+from .graph import SkeletonGraph, skeleton_degrees
+from .packed import PackedVolume, unpack
+from .resample import resample_binary
+from .distance import distance_field, disk_array, SLAB_VOXELS
+from .thinning import thin
+from .spheres import stamp
+from .inout import (save_measurements_npz, write_measurements_csv,
+                    format_values)
+
+
+def resize_and_get_pixel_size(im, x_pixel_size, y_pixel_size, z_pixel_size,
+                              method='majority', packed=False):
+    """Resamples im to cubic voxels of the largest pixel size.
+
+    The volume stays binary: see resample.resample_binary for method and
+    packed.  Returns the resampled volume and its pixel size.  VolumeData
+    can instead measure the original voxels with spacing (see
+    pixel_spacing), which needs no resampled copy.
+    """
     rows, cols, slices = im.shape
     # Get the pixel size of the longest direction.  The other directions
     # will be scaled to the same size.
     pixel_size = max(x_pixel_size, y_pixel_size, z_pixel_size)
-    scale = (pixel_size / x_pixel_size,
-             pixel_size / y_pixel_size,
-             pixel_size / z_pixel_size)
-    output_shape = (int(round(rows*scale[0],0)),
-                    int(round(cols*scale[1],0)),
-                    int(round(slices*scale[2],0)))
-    scaled_im = transform.resize(im, output_shape)
+    scale = (x_pixel_size / pixel_size,
+             y_pixel_size / pixel_size,
+             z_pixel_size / pixel_size)
+    output_shape = (max(int(round(rows*scale[0],0)), 1),
+                    max(int(round(cols*scale[1],0)), 1),
+                    max(int(round(slices*scale[2],0)), 1))
+    scaled_im = resample_binary(im, output_shape, method, packed=packed)
     return scaled_im, pixel_size
 
 
-
-def skeletonize(im):
-    skel = morphology.skeletonize_3d(im).astype('bool')
+def pixel_spacing(x_pixel_size, y_pixel_size, z_pixel_size):
+    """Returns (pixel_size, spacing) for VolumeData: the smallest pixel
+    size, and the voxel size along each axis in units of it."""
+    sizes = np.array([x_pixel_size, y_pixel_size, z_pixel_size], 'float')
+    pixel_size = sizes.min()
+    return float(pixel_size), tuple(float(i) for i in sizes / pixel_size)
+
+
+def skeletonize(im, method='skimage'):
+    # method 'skimage' (skeletonize_3d, which scikit-image 0.23 folded into
+    # skeletonize) or 'parallel' (thinning.thin, which unlike skimage keeps
+    # small components on the volume border, see thinning.py).
+    if method == 'parallel':
+        return thin(im)
+    if method != 'skimage':
+        raise ValueError('unknown thinning method: {}'.format(method))
+    from skimage import morphology
+    skeletonize_3d = getattr(morphology, 'skeletonize_3d',
+                             morphology.skeletonize)
+    skel = skeletonize_3d(im).astype('bool')
     return(skel)
 
 
-def distance_transform(im):
-    dt = ndimage.morphology.distance_transform_edt(im)
+def distance_transform(im, spacing=None):
+    # spacing: voxel size along each axis (isotropic if None).
+    from scipy import ndimage
+    dt = ndimage.distance_transform_edt(im, sampling=spacing)
     return dt
 
 
@@ -42,11 +77,62 @@ def calculate_diameter(skel, dt, pixel_size):
     return diams
 
 
+# Diameter classes of the skeleton voxels, and their bit in the class
+# column of a diameter table.
+DIAMETER_CLASSES = {'all': 1, 'terminal': 2, 'node': 4, 'connected': 8}
+
+
+def diameter_table(coords, dt, shape, classes, exclude_edges=True,
+                   spacing=None):
+    """Gathers the diameter samples of every skeleton voxel in one table.
+
+    coords are the (3, n) skeleton voxels in C order, dt the distance
+    transform at them and classes maps names of DIAMETER_CLASSES to bool
+    selections of the voxels ('all' may be left out).  Returns a dict of
+    columns: 'diameter' (2 * dt), 'margin' (distance in voxels to the
+    nearest volume face, scaled by spacing if given) and 'class' (bits of
+    DIAMETER_CLASSES), plus the edge exclusion of calculate_diameter per
+    class: 'exclude_<name>' is twice the class average diameter and
+    'kept_<name>' marks the samples of the class that pass it.  With
+    exclude_edges False nothing is excluded.
+    """
+    coords = np.asarray(coords)
+    diams = np.asarray(dt) * 2
+    upper = np.array(shape)[:, None] - 1
+    margin = np.minimum(coords, upper - coords) if len(diams) \
+        else np.zeros((3, 0), dtype=np.intp)
+    if spacing is not None:
+        margin = margin * np.asarray(spacing, 'float')[:, None]
+    margin = margin.min(axis=0)
+    tags = np.zeros(len(diams), dtype=np.uint8)
+    table = {'diameter': diams, 'margin': margin, 'class': tags}
+    for name, bit in DIAMETER_CLASSES.items():
+        member = classes.get(name)
+        member = np.ones(len(diams), 'bool') if member is None else member
+        tags[member] |= bit
+        values = diams[member]
+        values = values[values>0]
+        av = 2 * int(np.average(values)) if len(values) else 0
+        av = av if exclude_edges else 0
+        table['exclude_' + name] = av
+        # crops [av:-av] of calculate_diameter (no crop when av is 0)
+        inside = margin >= av if av else np.ones(len(diams), 'bool')
+        table['kept_' + name] = member & inside & (diams>2)
+    return table
+
+
+def gather_diameters(table, pixel_size):
+    """Returns {class name: diameters} from a diameter_table, each equal
+    to calculate_diameter of that class mask."""
+    return dict((name, table['diameter'][table['kept_' + name]] * pixel_size)
+                for name in DIAMETER_CLASSES)
+
+
 def count_neighbors(skel):
-    strel = np.ones((3, 3, 3))
-    strel[1, 1, 1] = 0
-    conv = convolve(skel, strel, mode='same')
-    neighbors = np.round((conv * skel)).astype(np.uint8)
+    # Neighbor count of every skeleton voxel (0 off the skeleton).
+    coords = skel.nonzero()
+    neighbors = np.zeros(skel.shape, dtype=np.uint8)
+    neighbors[coords] = skeleton_degrees(coords, skel.shape)
     return neighbors
 
 
@@ -58,6 +144,7 @@ def find_nodes(neighbors):
 def label_ligaments(neighbors):
     ligaments = neighbors < 3
     ligaments[neighbors == 0] = 0
+    from skimage.measure import label
     labels = label(ligaments, connectivity=3)
     return labels
 
@@ -81,6 +168,7 @@ def remove_terminal_ligaments(labels, neighbors, return_terminal=False):
 
 
 def fnm2(im, skel, nodes, labels, dist):
+    from skimage import morphology
     node_mask = np.zeros(im.shape, dtype='bool')
     node_dialate = nodes > 0
     while True:
@@ -121,61 +209,260 @@ def fnm3(im, skel, nodes, labels, dist):
 
 
 def find_node_mask(im, skel, nodes, labels, distance_transform):
-    node_mask = np.zeros(im.shape, dtype='bool')
-    node_dist = (nodes * distance_transform).astype(np.uint8)
-    node_dist_list = np.unique(node_dist).tolist()
-    #print(node_dist_list)
-    spheres = SphereLookupTable(node_dist_list)
-    for dist in node_dist_list[1:]:
-        this_dist = np.zeros(im.shape)
-        this_dist[node_dist==dist] = 1
-        this_mask = spheres.get_mask(dist)
-        conv = convolve(this_dist,
-                        this_mask,
-                        mode='same')
-        conv = conv > 0.5
-        node_mask[conv==1] = 1
-
-    # spheres = SphereLookupTable(range(10))
-    # print(spheres.get_mask(2))
-    # test = np.zeros((7,7,7))
-    # test[3,3,3] = 1
-    # test = convolve(test, spheres.get_mask(node_dist_list[3]), mode='same')
-    # test = test > 0.5
-
-    return node_mask
-
-
-class SphereLookupTable(object):
-    # Generates a dictionary of sphere structuring elements.
-    # This way the structuring elements only have to be generated once.
-    table = {}
-
-    def __init__(self, radii):
-        for i in radii:
-            self.table[i] = self.generate_mask(i)
-
-    def generate_mask(self, r):
-        return morphology.ball(r, dtype='bool')
-
-    def get_mask(self, r):
-        return self.table[r]
+    # Union of the inscribed spheres of the node voxels.
+    coords = np.nonzero(nodes)
+    return sphere_union(im.shape, coords, distance_transform[coords])
+
+
+def sphere_union(shape, coords, radii, packed=False, slab=None,
+                 spacing=None):
+    """Returns the voxels inside any ball around coords.
+
+    The radius of every ball is its radius rounded down, as ball(r) masks,
+    and balls of radius 0 are left out.  A voxel p is inside if
+    min(|p - s|^2 - r_s^2) <= 0 over the seeds s.  That minimum is a
+    distance transform seeded with -r^2, computed exactly with three
+    separable 1D passes.  A seed further than R, the largest radius, along
+    an axis cannot cover p, so a pass reaching fewer than 16 voxels takes
+    the minimum of the 2R + 1 shifted parabolas, and a longer one builds
+    the lower envelope of the parabolas along every line (Felzenszwalb and
+    Huttenlocher); either way the cost is O(V) for V voxels.  The volume
+    is processed in slabs along the first axis that read R planes on
+    either side, each over the bounding box of its seeds, and written to
+    a bool array or (packed=True) a PackedVolume.  By default a slab holds
+    about distance.SLAB_VOXELS voxels with those planes, and is at least
+    2R planes thick.
+
+    Without spacing, balls that hold fewer voxels (about 4 r^3 each) than
+    the volume are instead stamped into a bool output from the cached
+    offsets of spheres.stamp.
+
+    With spacing, the voxel size along each axis, distances and radii are
+    in those units: the squares of the parabolas are weighted by
+    spacing^2 and an axis reaches R / spacing voxels.
+    """
+    coords = np.asarray(coords)
+    radii = np.floor(np.asarray(radii)).astype(np.int64)
+    keep = radii >= 1
+    coords, radii = coords[:, keep], radii[keep]
+    out = PackedVolume.zeros(shape) if packed else np.zeros(shape, 'bool')
+    if not len(radii):
+        return out
+    if (spacing is None and not packed
+            and (4 * radii.astype(float) ** 3).sum() < np.prod(shape)):
+        # few small balls: stamp their cached offsets
+        for r in np.unique(radii):
+            stamp(out, coords[:, radii == r], r)
+        return out
+    if spacing is None:
+        weights = (1, 1, 1)
+        reach = (int(radii.max()),) * 3
+        dtype, far = np.int32, _FAR
+    else:
+        weights = tuple(float(i) ** 2 for i in spacing)
+        reach = tuple(int(radii.max() / float(i)) for i in spacing)
+        dtype, far = np.float64, np.inf
+    reach_up = np.array(reach)
+    if slab is None:
+        lo = np.maximum(coords.min(axis=1) - reach_up, 0)
+        hi = np.minimum(coords.max(axis=1) + reach_up + 1, shape)
+        plane = max(int(np.prod(hi[1:] - lo[1:])), 1)
+        slab = max(SLAB_VOXELS // plane - 2 * reach[0], 2 * reach[0], 1)
+    for start in range(0, shape[0], slab):
+        stop = min(start + slab, shape[0])
+        near = ((coords[0] >= start - reach[0])
+                & (coords[0] < stop + reach[0]))
+        if not near.any():
+            continue
+        seeds, r = coords[:, near], radii[near]
+        lo = np.maximum(seeds.min(axis=1) - reach_up, 0)
+        hi = np.minimum(seeds.max(axis=1) + reach_up + 1, shape)
+        lo[0] = max(start - reach[0], 0)
+        hi[0] = min(stop + reach[0], shape[0])
+        field = np.full(hi - lo, far, dtype=dtype)
+        field[tuple(seeds - lo[:, None])] = -r ** 2
+        for axis in range(3):
+            if reach[axis] < _ENVELOPE_REACH:
+                field = _min_parabolas(field, axis, reach[axis],
+                                       weights[axis])
+            else:
+                field = _lower_envelope(field, axis, weights[axis], far)
+        inside = field[start - lo[0]:stop - lo[0]] <= 0
+        out[start:stop, lo[1]:hi[1], lo[2]:hi[2]] = inside
+    return out
+
+
+# Field value of voxels without a seed; far above any squared radius.
+_FAR = 1 << 30
+
+# Reach (in voxels) from which a 1D pass builds the lower envelope; below
+# it the 2R + 1 shifted minima of whole slabs are faster in numpy.
+_ENVELOPE_REACH = 16
+
+
+def _min_parabolas(field, axis, reach, weight=1):
+    # out[x] = min over |k| <= reach of field[x + k] + weight * k^2 along
+    # axis.
+    field = np.moveaxis(field, axis, 0)
+    out = field.copy()
+    for k in range(1, min(reach, len(field) - 1) + 1):
+        np.minimum(out[k:], field[:-k] + weight * k * k, out=out[k:])
+        np.minimum(out[:-k], field[k:] + weight * k * k, out=out[:-k])
+    return np.moveaxis(out, 0, axis)
+
+
+def _lower_envelope(field, axis, weight=1, far=_FAR, chunk=1 << 20):
+    # out[x] = min over y of field[y] + weight * (x - y)^2 along axis.
+    # Values >= far are no seeds, and lines without seeds stay far.  The
+    # lines are processed together, about chunk voxels at a time.
+    moved = np.moveaxis(field, axis, 0)
+    n = moved.shape[0]
+    flat = moved.reshape((n, -1))
+    out = np.empty(flat.shape, field.dtype)
+    step = max(chunk // n, 1)
+    for i in range(0, flat.shape[1], step):
+        out[:, i:i + step] = _envelope_lines(
+            flat[:, i:i + step].astype(np.float64), weight, far)
+    return np.moveaxis(out.reshape(moved.shape), 0, axis)
+
+
+def _envelope_lines(f, weight, far):
+    # Lower envelope of the parabolas f[y] + weight * (x - y)^2 of every
+    # column of f, one step along the lines at a time.  v holds the
+    # vertices of the envelope and z the boundaries between them, k the
+    # index of the last parabola of each line (-1 while it has none).
+    # Arrays are indexed flat, row * m + line.
+    n, m = f.shape
+    f = f.ravel()
+    g = f + np.repeat(weight * np.arange(n, dtype=np.float64) ** 2, m)
+    v = np.zeros(n * m, np.intp)
+    z = np.empty((n + 1) * m)
+    k = np.full(m, -m, np.intp)
+    for q in range(n):
+        lines = np.flatnonzero(f[q * m:(q + 1) * m] < far)
+        if not len(lines):
+            continue
+        gq = g[q * m + lines]
+        s = np.full(len(lines), -np.inf)
+        todo = np.flatnonzero(k[lines] >= 0)
+        while len(todo):
+            c = lines[todo]
+            top = k[c] + c
+            vk = v[top]
+            st = (gq[todo] - g[vk * m + c]) / (2 * weight * (q - vk))
+            s[todo] = st
+            drop = st <= z[top]
+            todo = todo[drop]
+            k[c[drop]] -= m
+            todo = todo[k[lines[todo]] >= 0]
+        top = k[lines]
+        s[top < 0] = -np.inf
+        top += m
+        k[lines] = top
+        top += lines
+        v[top] = q
+        z[top] = s
+        z[top + m] = np.inf
+    out = np.full(n * m, far, dtype=np.float64)
+    lines = np.flatnonzero(k >= 0)
+    j = lines.copy()
+    for q in range(n):
+        while True:
+            step = z[j + m] < q
+            if not step.any():
+                break
+            j[step] += m
+        vj = v[j]
+        out[q * m + lines] = weight * (q - vj) ** 2 + f[vj * m + lines]
+    return out.reshape((n, m))
+
+
+class CalculationCancelled(Exception):
+    """Raised by VolumeData.calculate after cancel() was called."""
+
+
+def _freeze(value):
+    # Parameter value as stored in a stage cache key.
+    return tuple(value) if isinstance(value, list) else value
 
 
 class VolumeData(object):
+    # Stages of calculate(): name -> (method, input stages, parameters).
+    # Outputs are cached; a stage re-runs only when one of its inputs was
+    # recomputed or one of its parameters (attributes of the same name)
+    # changed.  'volume' is the input volume self.im.  Settings that change
+    # how a stage runs but not its output (halo, processes) are no
+    # parameters.
+    stages = {
+        'skeleton': ('_skeleton_stage', ('volume',),
+                     ('thinning', 'tile_shape')),
+        'distance': ('_distance_stage', ('volume',),
+                     ('spacing', 'distance_precision')),
+        'graph': ('_graph_stage', ('skeleton', 'distance'), ()),
+        'masks': ('_mask_stage', ('graph',), ('packed_masks',)),
+        'node_mask': ('_node_mask_stage', ('graph',),
+                      ('packed_masks', 'spacing')),
+        'edge_lengths': ('_edge_length_stage', ('graph',), ('spacing',)),
+        'lengths': ('_length_stage', ('graph', 'edge_lengths'),
+                    ('pixel_size',)),
+        'diameter_table': ('_diameter_table_stage', ('graph',),
+                           ('exclude_edges', 'spacing')),
+        'diameters': ('_diameter_stage', ('diameter_table',),
+                      ('pixel_size',)),
+    }
 
     def __init__(self, im, pixel_size = 1.0, status=None, progress=None,
-                 display=None, plot=None, invert_im = False):
+                 display=None, plot=None, invert_im = False,
+                 packed_masks=True, spacing=None,
+                 distance_precision='float64', thinning='skimage'):
         self.pixel_size = pixel_size
+        # voxel size along each axis in units of pixel_size (None for
+        # cubic voxels); see pixel_spacing
+        self.spacing = None if spacing is None else tuple(
+            float(i) for i in spacing)
+        # dtype of the distance transform: 'float64', 'float32' or
+        # 'uint16' (see distance.distance_field)
+        self.distance_precision = distance_precision
+        # skeletonize method: 'skimage' or 'parallel' (see thinning.py)
+        self.thinning = thinning
+        # store skel, nodes, terminal and node_mask 8 voxels per byte
+        self.packed_masks = packed_masks
+        # drop diameters closer to the faces than twice the class average
+        self.exclude_edges = True
+        # path of the file the volume came from, kept in project files
+        self.source = None
+        # tiled execution, see calculate_tiled
+        self.tile_shape = None
+        self.halo = None
+        self.processes = 1
 
         # widget control
         self.status = status
         self.progress = progress
         self.display = display
         self.plot = plot
+        # listener(message, value) receives progress instead of the widgets,
+        # e.g. a signal of a worker thread; repeated updates within a stage
+        # are dropped if less than progress_interval seconds apart
+        self.listener = None
+        self.progress_interval = 0.1
+        self._last_progress = 0.0
+        self._cancel = threading.Event()
+        self._computed = None
+
+        # stage cache: name -> (key, output), and output versions
+        self._cache = {}
+        self._versions = {}
+        self._counter = itertools.count(1)
 
         # volume data
-        self.im = im < 1 if invert_im else im > 0# Volume data
+        if isinstance(im, np.ndarray):
+            self.im = im < 1 if invert_im else im > 0# Volume data
+        else: # packed or lazy volumes (e.g. tiff.TiffVolume) stay as they are
+            self.im = ~PackedVolume.pack(im) if invert_im else im
+        self._clear_results()
+
+    def _clear_results(self):
         self.skel = None #binary mask locating the backbone
         self.nodes = None #binary mask locating the nodes
         self.terminal = None # binary mask locating terminal ligaments
@@ -186,63 +473,254 @@ class VolumeData(object):
         self.node_diameters = None
         self.connected_diameters = None
         self.percent_terminal = None
-
-        # data properties
-        self.shape = self.im.shape
-
-    def calculate(self):
-        if self.progress is not None:
+        self.distance = None # distance transform, see distance_field
+        self.graph = None # skeleton graph.SkeletonGraph
+        self.diameter_table = None # see diameter_table()
+        self.tile_timings = None
+
+    @property
+    def im(self):
+        return self._im
+
+    @im.setter
+    def im(self, im):
+        # A new volume makes every stage stale.
+        self._im = im
+        self.shape = im.shape
+        self._versions['volume'] = next(self._counter)
+
+    def stage(self, name):
+        """Returns the output of a stage, running it (and any stale stage
+        it depends on) if its inputs or parameters changed."""
+        if name == 'volume':
+            return self.im
+        method, inputs, params = self.stages[name]
+        values = [self.stage(i) for i in inputs]
+        key = (tuple(self._versions[i] for i in inputs),
+               tuple(_freeze(getattr(self, p)) for p in params))
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        self._check_cancelled()
+        value = getattr(self, method)(*values)
+        self._cache[name] = (key, value)
+        self._versions[name] = next(self._counter)
+        if self._computed is not None:
+            self._computed.append(name)
+        return value
+
+    def cancel(self):
+        """Makes a running (or the next) calculate() stop before its next
+        stage, tile or distance transform slab and raise
+        CalculationCancelled.  Safe to call from any thread."""
+        self._cancel.set()
+
+    def reset_cancel(self):
+        """Forgets a cancel() issued before a new calculation is
+        requested, e.g. when its worker thread is set up."""
+        self._cancel.clear()
+
+    def _check_cancelled(self):
+        if self._cancel.is_set():
+            raise CalculationCancelled()
+
+    def outputs(self):
+        # {stage name: output} of every cached stage.
+        return dict((name, value) for name, (_, value) in self._cache.items())
+
+    def restore(self, outputs):
+        """Fills the stage cache with outputs computed earlier (see
+        project.load_project), keyed on the current volume and
+        parameters.  A stage is only restored with all of its inputs."""
+        for name, (_, inputs, params) in self.stages.items():
+            if name not in outputs or not all(
+                    i in self._versions for i in inputs):
+                continue
+            key = (tuple(self._versions[i] for i in inputs),
+                   tuple(_freeze(getattr(self, p)) for p in params))
+            self._cache[name] = (key, outputs[name])
+            self._versions[name] = next(self._counter)
+
+    def invalidate(self, name=None):
+        # Forgets the output of a stage (all stages if name is None), so it
+        # and everything downstream re-runs.
+        if name is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(name, None)
+
+    def calculate(self, tile_shape=None, halo=None, processes=1):
+        """Runs every stale stage and stores the results as attributes.
+
+        Only the stages downstream of a change re-run: after changing
+        pixel_size, calling calculate() again rescales the lengths and
+        diameters without skeletonizing.  With tile_shape the skeleton is
+        computed tile by tile, see calculate_tiled.
+
+        After cancel() it raises CalculationCancelled; the stages it
+        computed are dropped and the results cleared.  A cancel() issued
+        before the run starts cancels it too, and is forgotten when it
+        ends.
+        """
+        self.tile_shape = tile_shape
+        self.halo = halo
+        self.processes = processes
+        self._computed = []
+        try:
+            self._calculate()
+        except CalculationCancelled:
+            for name in self._computed:
+                self._cache.pop(name, None)
+            self._clear_results()
+            self.update_progress('Cancelled', 100)
+            raise
+        finally:
+            self._computed = None
+            self._cancel.clear()
+
+    def _calculate(self):
+        if self.progress is not None and self.listener is None:
             self.progress.setVisible(True)
+        self.tile_timings = self.stage('skeleton')['timings']
+        self.distance = self.stage('distance')
+        self.graph = self.stage('graph')
+        self.skel, self.nodes, self.terminal = self.stage('masks')
+        self.node_mask = self.stage('node_mask')
+        self.lengths = self.stage('lengths')
+        #self.plot.plot(self.lengths, 'length [pixels]')
+        self.diameter_table = self.stage('diameter_table')
+        diameters = self.stage('diameters')
+        self.all_diameters = diameters['all']
+        if self.plot is not None and self.listener is None:
+            self.plot.plot(self.all_diameters, 'diameter [units]')
+        self.terminal_diameters = diameters['terminal']
+        self.node_diameters = diameters['node']
+        self.connected_diameters = diameters['connected']
+        # NaN without diameters, like the means of the empty classes
+        n_all = len(self.all_diameters)
+        self.percent_terminal = (100 * len(self.terminal_diameters) / n_all
+                                 if n_all else float('nan'))
 
-        # Skeletonize
-        self.update_progress('Skeletonizing...', 1)
-        self.skel = skeletonize(self.im)
+        # Finish
+        self.update_progress('', 100)
 
-        # Distance
+    def calculate_tiled(self, tile_shape=(128, 128, 128), halo=None,
+                        processes=1):
+        """Measures the volume tile by tile with a bounded working set.
+
+        Every tile is read with a halo of halo voxels (grown automatically
+        to twice the largest ligament radius) and only its skeleton voxels
+        are kept; the skeleton graph is then built from all of them, which
+        joins ligaments across tile seams.  The distance transform is
+        computed in slabs into a temporary file.  Thinning near a seam can
+        differ by a voxel from thinning the whole volume, otherwise the
+        results are the same as calculate().
+
+        With processes other than 1 the tiles run in a process pool (None
+        for one process per CPU).  The (tile, seconds) of every tile are
+        kept in tile_timings.
+        """
+        self.calculate(tile_shape, halo, processes)
+
+    def _skeleton_stage(self, im):
+        # {'coords': (3, n) skeleton voxels in C order, 'timings': (tile,
+        # seconds) of every tile, None unless tiled}.
+        self.update_progress('Skeletonizing...', 1)
+        if self.tile_shape is not None:
+            from .tiling import tiled_skeleton
+
+            def tile_done(done, total):
+                self._check_cancelled()
+                self.update_progress('Skeletonizing tile {} of {}...'.format(
+                    done, total), 1 + 19 * done // total, throttle=True)
+
+            coords, timings = tiled_skeleton(im, self.tile_shape, self.halo,
+                                             tile_done, self.processes,
+                                             self.thinning)
+            return {'coords': coords, 'timings': timings}
+        skel = skeletonize(unpack(im), self.thinning)
+        return {'coords': np.array(skel.nonzero()), 'timings': None}
+
+    def _distance_stage(self, im):
+        # Tiled runs keep the field in a temporary file, like the volume
+        # out of memory.
         self.update_progress('Calculating distance transform...', 20)
-        distance = distance_transform(self.im)
-
-        # Find number of neighbors
-        self.update_progress('Counting pixel neighbors...', 25)
-        neighbors = count_neighbors(self.skel)
-
-        # Find nodes
-        self.update_progress('Finding nodes...', 30)
-        self.nodes = find_nodes(neighbors)
-
-        # Label ligaments
-        self.update_progress('Separating ligaments...', 40)
-        labels = label_ligaments(neighbors)
-
-        # Remove terminal ligaments
-        self.update_progress('Finding terminal ligaments...', 50)
-        skel_without_term, self.terminal = remove_terminal_ligaments(
-            labels, neighbors, True)
-
-        # Find node mask
-        #self.update_progress('Finding node mask...', 60)
-        #self.node_mask =  fnm3(self.im, self.skel, self.nodes, labels,
-        #                            distance)
-
-        # Calculate lengths
+        out = None
+        if self.tile_shape is not None:
+            out = disk_array(self.shape, self.distance_precision)
+
+        def slab_done(done, total):
+            self._check_cancelled()
+            self.update_progress('Calculating distance transform...',
+                                 20 + 10 * done // total, throttle=True)
+
+        return distance_field(im, self.spacing, self.distance_precision,
+                              out=out, progress=slab_done)
+
+    def _graph_stage(self, skeleton, distance):
+        # Neighbors, junctions, ligaments and terminal ligaments, as a
+        # graph.SkeletonGraph.
+        self.update_progress('Building skeleton graph...', 30)
+        coords = skeleton['coords']
+        return SkeletonGraph(self.shape, coords, dt=distance[tuple(coords)])
+
+    def _mask_stage(self, graph):
+        # (skel, nodes, terminal) masks.
+        return (graph.volume(None, self.packed_masks),
+                graph.volume(graph.node_mask(), self.packed_masks),
+                graph.volume(graph.terminal_mask(), self.packed_masks))
+
+    def _node_mask_stage(self, graph):
+        self.update_progress('Finding node mask...', 50)
+        nodes = graph.node_mask()
+        return sphere_union(graph.shape, graph.coords[:, nodes],
+                            graph.dt[nodes], self.packed_masks,
+                            spacing=self.spacing)
+
+    def _edge_length_stage(self, graph):
         self.update_progress('Calculating length...', 60)
-        self.lengths = calculate_lengths(labels * skel_without_term, self.pixel_size)
-        #self.plot.plot(self.lengths, 'length [pixels]')
+        return graph.edge_lengths(self.spacing)
 
-        # Diameter
-        self.update_progress('Calculating diameter...', 70)
-        self.all_diameters = calculate_diameter(self.skel, distance, self.pixel_size)
-        if self.plot is not None:
-            self.plot.plot(self.all_diameters, 'diameter [units]')
-        self.terminal_diameters = calculate_diameter(self.terminal, distance, self.pixel_size)
-        self.node_diameters = calculate_diameter(self.nodes, distance, self.pixel_size)
-        self.connected_diameters = calculate_diameter(skel_without_term, distance, self.pixel_size)
-        self.percent_terminal = 100* len(self.terminal_diameters) / len(self.all_diameters)
+    def _length_stage(self, graph, edge_lengths):
+        lengths = edge_lengths[~graph.terminal]
+        return lengths[lengths>0] * self.pixel_size
 
-        # Finish
-        self.update_progress('', 100)
+    def _diameter_table_stage(self, graph):
+        self.update_progress('Calculating diameter...', 70)
+        classes = {'terminal': graph.terminal_mask(),
+                   'node': graph.node_mask(),
+                   'connected': graph.connected_mask()}
+        return diameter_table(graph.coords, graph.dt, graph.shape, classes,
+                              self.exclude_edges, self.spacing)
+
+    def _diameter_stage(self, table):
+        return gather_diameters(table, self.pixel_size)
+
+    def measurements(self):
+        # Returns ({name: array}, metadata) of every measurement.
+        columns = {'all_diameters': self.all_diameters,
+                   'connected_diameters': self.connected_diameters,
+                   'terminal_diameters': self.terminal_diameters,
+                   'node_diameters': self.node_diameters,
+                   'lengths': self.lengths}
+        metadata = {'pixel_size': self.pixel_size,
+                    'spacing': self.spacing,
+                    'shape': list(self.shape),
+                    'percent_terminal': self.percent_terminal}
+        return columns, metadata
+
+    def export_binary(self, path):
+        # Compressed .npz columns, read back with inout.load_measurements.
+        save_measurements_npz(path, *self.measurements())
+
+    def export_csv(self, path):
+        write_measurements_csv(path, *self.measurements())
 
     def export(self, path):
+        if str(path).endswith('.npz'):
+            return self.export_binary(path)
+        if str(path).endswith('.csv'):
+            return self.export_csv(path)
         with open(path, 'w') as f:
             f.write('Average of all ligament diameters: ')
             f.write(str(round(np.mean(self.all_diameters),2)))
@@ -256,7 +734,7 @@ class VolumeData(object):
             f.write('Average node point diameter: ')
             f.write(str(round(np.mean(self.node_diameters), 2)))
             f.write('\n')
-            f.write('Average ligament length (node to node) (NOT ACCURATE): ')
+            f.write('Average ligament length (node to node): ')
             f.write(str(round(np.mean(self.lengths), 2)))
             f.write('\n')
             f.write('Percent terminal ligaments (linear length): ')
@@ -266,26 +744,37 @@ class VolumeData(object):
 
             f.write('All diameter measurements')
             f.write('\n')
-            f.write('\n'.join([str(i) for i in self.all_diameters]))
+            f.write(format_values(self.all_diameters))
             f.write('\n\n')
             f.write('Connected ligament diameter measurements')
             f.write('\n')
-            f.write('\n'.join([str(i) for i in self.connected_diameters]))
+            f.write(format_values(self.connected_diameters))
             f.write('\n\n')
             f.write('Terminal ligament diameter measurements')
             f.write('\n')
-            f.write('\n'.join([str(i) for i in self.terminal_diameters]))
+            f.write(format_values(self.terminal_diameters))
             f.write('\n\n')
             f.write('Node point diameter measurements')
             f.write('\n')
-            f.write('\n'.join([str(i) for i in self.node_diameters]))
+            f.write(format_values(self.node_diameters))
             f.write('\n\n')
             f.write('Ligament length measurements')
             f.write('\n')
-            f.write('\n'.join([str(i) for i in self.lengths]))
+            f.write(format_values(self.lengths))
             f.write('\n\n')
 
-    def update_progress(self, message, value):
+    def update_progress(self, message, value, throttle=False):
+        # Throttled updates (repeated within a stage) are dropped if less
+        # than progress_interval seconds after the last update.  Nothing is
+        # rendered here; the view is redrawn once the results are in.
+        now = time.perf_counter()
+        if throttle and value < 100 and \
+                now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        if self.listener is not None:
+            self.listener(message, value)
+            return
         if self.status is not None:
             self.status.setText(message)
         else:
@@ -293,14 +782,10 @@ class VolumeData(object):
         if self.progress is not None: self.progress.setValue(value)
         if self.progress is not None and value == 100:
             self.progress.setVisible(False)
-        if self.display is not None:
-            self.display([0, self.shape[0],
-                          0, self.shape[1],
-                          0, self.shape[2]])
 
 
 if __name__ == '__main__':
-    from inout import read_tiff_stack
+    from .inout import read_tiff_stack
     fpath = (r'E:\E_Documents\Research\Computer Vision Collaboration\Erica '
              r'Lilleodden/fib serial section data.tif')
     im = read_tiff_stack(fpath)
@@ -310,7 +795,5 @@ if __name__ == '__main__':
     opath = (r'E:\E_Documents\Research\Computer Vision Collaboration\Erica '
              r'Lilleodden/data.txt')
     volume.export(opath)
-    #a = SphereLookupTable(10)
-    #print(a.get_mask(3))
     #print('start')
     #im, pixel_size = resize_and_get_pixel_size(im, 1,1,2)
@@ -0,0 +1,163 @@
+"""Bit-packed boolean volumes."""
+import numpy as np
+
+# Number of set bits of every byte value.
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None],
+                          axis=1).sum(axis=1)
+
+
+class PackedVolume(object):
+    """A 3D boolean volume stored 8 voxels per byte.
+
+    Voxels are packed along the last axis with np.packbits, so a slab or
+    sub-block unpacks without touching the rest of the volume.  Indexing
+    works like a bool ndarray: basic indexing returns an unpacked bool
+    array and a tuple of coordinate arrays (as from np.nonzero) gathers
+    single voxels.  packed may be any uint8 array, e.g. a memory map.
+    """
+    dtype = np.dtype('bool')
+    ndim = 3
+
+    def __init__(self, packed, shape):
+        self.packed = packed
+        self.shape = tuple(int(i) for i in shape)
+
+    @classmethod
+    def pack(cls, volume, slab=64):
+        """Packs a bool volume, slab by slab to bound temporaries."""
+        if isinstance(volume, PackedVolume):
+            return volume
+        shape = volume.shape
+        packed = np.empty(shape[:2] + (-(-shape[2] // 8),), dtype=np.uint8)
+        for i in range(0, shape[0], slab):
+            packed[i:i + slab] = np.packbits(
+                np.asarray(volume[i:i + slab], dtype='bool'), axis=-1)
+        return cls(packed, shape)
+
+    @classmethod
+    def zeros(cls, shape):
+        shape = tuple(int(i) for i in shape)
+        return cls(np.zeros(shape[:2] + (-(-shape[2] // 8),), dtype=np.uint8),
+                   shape)
+
+    @classmethod
+    def from_coords(cls, shape, coords):
+        """Returns a volume with the voxels at coords (3, n) set."""
+        volume = cls.zeros(shape)
+        x, y, z = (np.asarray(c, dtype=np.intp) for c in coords)
+        bits = (np.uint8(0x80) >> (z & 7).astype(np.uint8))
+        np.bitwise_or.at(volume.packed, (x, y, z >> 3), bits)
+        return volume
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) == 3 and all(
+                isinstance(k, np.ndarray) and k.ndim > 0 for k in key):
+            return self.gather(*key)
+        a, b, c = _expand(key)
+        sub = self.packed[a, b]
+        if isinstance(c, slice):
+            z = np.arange(*c.indices(self.shape[2]))
+        else:
+            z = np.asarray(c)
+            z = np.where(z < 0, z + self.shape[2], z)
+        if z.size == 0:
+            return np.zeros(sub.shape[:-1] + z.shape, dtype='bool')
+        first, last = int(z.min()) // 8, int(z.max()) // 8 + 1
+        bits = np.unpackbits(sub[..., first:last], axis=-1)
+        return bits[..., z - first * 8].astype('bool')
+
+    def gather(self, x, y, z):
+        """Returns the voxels at coordinate arrays x, y, z."""
+        z = np.asarray(z)
+        byte = self.packed[x, y, z >> 3]
+        return ((byte >> (7 - (z & 7)).astype(np.uint8)) & 1).astype('bool')
+
+    def __setitem__(self, key, value):
+        # Assigns a region given by unit-step slices (or ints) on every axis.
+        a, b, c = _expand(key)
+        if not isinstance(c, slice):
+            c = slice(int(c), int(c) + 1)
+        start, stop, step = c.indices(self.shape[2])
+        if step != 1:
+            raise IndexError('PackedVolume only assigns unit-step slices')
+        if stop <= start:
+            return
+        first, last = start // 8, (stop - 1) // 8 + 1
+        region = np.unpackbits(self.packed[a, b, first:last], axis=-1)
+        region[..., start - first * 8:stop - first * 8] = value
+        self.packed[a, b, first:last] = np.packbits(region, axis=-1)
+
+    def __array__(self, dtype=None, copy=None):
+        volume = self[:, :, :]
+        return volume if dtype is None else volume.astype(dtype)
+
+    def astype(self, dtype):
+        return np.asarray(self).astype(dtype)
+
+    def iter_slabs(self, slab=64):
+        """Yields (start, bool slab) along the first axis."""
+        for i in range(0, self.shape[0], slab):
+            yield i, self[i:i + slab]
+
+    def count_nonzero(self):
+        return int(_POPCOUNT[np.asarray(self.packed)].sum())
+
+    def sum(self):
+        return self.count_nonzero()
+
+    def any(self):
+        return bool(np.asarray(self.packed).any())
+
+    def max(self):
+        return self.any()
+
+    def nonzero(self, slab=64):
+        """Returns the coordinate arrays of set voxels, like np.nonzero."""
+        coords = [np.nonzero(s) for _, s in self.iter_slabs(slab)]
+        if not coords:
+            return tuple(np.zeros(0, dtype=np.intp) for _ in range(3))
+        starts = range(0, self.shape[0], slab)
+        return (np.concatenate([c[0] + i for c, i in zip(coords, starts)]),
+                np.concatenate([c[1] for c in coords]),
+                np.concatenate([c[2] for c in coords]))
+
+    def __invert__(self):
+        packed = ~self.packed
+        tail = self.shape[2] % 8
+        if tail: # keep the padding bits of the last byte clear
+            packed[..., -1] &= np.uint8((0xff << (8 - tail)) & 0xff)
+        return PackedVolume(packed, self.shape)
+
+    def copy(self):
+        return PackedVolume(np.array(self.packed), self.shape)
+
+
+def _expand(key):
+    # Expands a basic index to one entry per axis.
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = [k is Ellipsis for k in key].index(True)
+        key = key[:i] + (slice(None),) * (4 - len(key)) + key[i + 1:]
+    if len(key) > 3:
+        raise IndexError('too many indices for a 3D volume')
+    return key + (slice(None),) * (3 - len(key))
+
+
+def unpack(volume):
+    """Returns volume as an ndarray, reading a PackedVolume or other lazy
+    volume (e.g. tiff.TiffVolume) in full."""
+    if volume is None or isinstance(volume, np.ndarray):
+        return volume
+    return np.asarray(volume)
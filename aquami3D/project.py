@@ -0,0 +1,325 @@
+"""Project files that keep every computed product of a VolumeData.
+
+A project file holds the input volume, the outputs of every VolumeData
+stage, the parameters they were computed with and a reference to the
+source file, so reopening it needs no computation.
+
+Layout: MAGIC, the 8 byte offset of the JSON index, then the sections,
+then the index.  Each section is an array stored either raw, aligned for
+memory mapping, or as zlib-compressed chunks of rows along its first axis,
+of which only the chunks a slice touches are decompressed.  Bit-packed
+volumes and the distance transform use compressed chunks, the skeleton
+tables raw sections.
+"""
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from .cache import source_key
+from .distance import SquaredDistance
+from .graph import SkeletonGraph
+from .measure import VolumeData
+from .packed import PackedVolume
+
+MAGIC = b'AQUAMI3D-PROJECT\n'
+VERSION = 1
+# Alignment of raw sections, so they can be memory-mapped.
+ALIGN = 4096
+# Bytes of uncompressed data per chunk of a compressed section.
+CHUNK_SIZE = 1 << 22
+
+# SkeletonGraph attributes saved in a project.
+GRAPH_ARRAYS = ('coords', 'dt', 'degrees', 'voxel_node', 'voxel_edge',
+                'node_ptr', 'node_voxels', 'node_size', 'node_centroid',
+                'node_degree', 'edge_ptr', 'edge_voxels', 'edge_size',
+                'terminal', 'link_edge', 'link_node', 'edge_nodes', 'indices',
+                'edge_ids', 'indptr')
+
+
+class ChunkedArray(object):
+    """Read-only array stored as compressed chunks of rows.
+
+    Slicing decompresses only the chunks under the rows asked for; other
+    indexes, and np.asarray, read everything.
+    """
+
+    def __init__(self, path, entry):
+        self.path = path
+        self.shape = tuple(entry['shape'])
+        self.dtype = np.dtype(entry['dtype'])
+        self.ndim = len(self.shape)
+        self.rows = entry['rows']
+        self.chunks = entry['chunks']
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_rows(self, start, stop):
+        # Rows start:stop, decompressing the chunks that hold them.
+        row_shape = self.shape[1:]
+        first, last = start // self.rows, (stop - 1) // self.rows + 1
+        parts = []
+        with open(self.path, 'rb') as f:
+            for offset, nbytes in self.chunks[first:last]:
+                f.seek(offset)
+                data = zlib.decompress(f.read(nbytes))
+                parts.append(np.frombuffer(data, self.dtype).reshape(
+                    (-1,) + row_shape))
+        if not parts:
+            return np.zeros((0,) + row_shape, self.dtype)
+        rows = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        return rows[start - first * self.rows:stop - first * self.rows]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        head, rest = key[0] if key else slice(None), key[1:]
+        if isinstance(head, slice):
+            start, stop, step = head.indices(self.shape[0])
+            if step == 1:
+                rows = self._read_rows(start, max(stop, start))
+                return rows[(slice(None),) + rest]
+        elif isinstance(head, (int, np.integer)):
+            i = int(head) + self.shape[0] if head < 0 else int(head)
+            if not 0 <= i < self.shape[0]:
+                raise IndexError('index out of range')
+            return self._read_rows(i, i + 1)[(0,) + rest]
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self._read_rows(0, self.shape[0])
+        return data if dtype is None else data.astype(dtype)
+
+
+def _write_raw(f, array):
+    array = np.ascontiguousarray(array)
+    f.write(b'\0' * (-f.tell() % ALIGN))
+    offset = f.tell()
+    array.tofile(f)
+    return {'encoding': 'raw', 'offset': offset}
+
+
+def _write_chunked(f, array, level=6):
+    array = np.ascontiguousarray(array)
+    row_bytes = max(int(np.prod(array.shape[1:])) * array.itemsize, 1)
+    rows = max(CHUNK_SIZE // row_bytes, 1)
+    chunks = []
+    for i in range(0, len(array), rows):
+        data = zlib.compress(array[i:i + rows].tobytes(), level)
+        chunks.append((f.tell(), len(data)))
+        f.write(data)
+    return {'encoding': 'zlib', 'rows': rows, 'chunks': chunks}
+
+
+def _packed_bytes(volume):
+    # Bit-packed bytes and shape of a bool volume.
+    volume = PackedVolume.pack(volume)
+    return np.asarray(volume.packed), volume.shape
+
+
+def save_project(path, volume_data):
+    """Writes a VolumeData, with every computed stage, to a project file.
+
+    The file is written next to path and moved into place when complete.
+    """
+    sections = {}
+    volumes = {}
+    fields = {}
+    arrays = {}
+    outputs = volume_data.outputs()
+    volumes['im'] = volume_data.im
+    if 'skeleton' in outputs:
+        arrays['skeleton/coords'] = outputs['skeleton']['coords']
+    distance_scale = None
+    if 'distance' in outputs:
+        distance = outputs['distance']
+        if isinstance(distance, SquaredDistance):
+            distance_scale = distance.scale
+            distance = distance.squared
+        fields['distance'] = distance
+    if 'masks' in outputs:
+        for name, mask in zip(('skel', 'nodes', 'terminal'),
+                              outputs['masks']):
+            volumes[name] = mask
+    if 'node_mask' in outputs:
+        volumes['node_mask'] = outputs['node_mask']
+    if 'graph' in outputs:
+        graph = outputs['graph']
+        for name in GRAPH_ARRAYS:
+            arrays['graph/' + name] = getattr(graph, name)
+        arrays['graph/pairs'] = np.array(graph.pairs)
+    for name in ('edge_lengths', 'lengths'):
+        if name in outputs:
+            arrays[name] = outputs[name]
+    scalars = {}
+    if 'diameter_table' in outputs:
+        for name, value in outputs['diameter_table'].items():
+            if np.ndim(value):
+                arrays['diameter_table/' + name] = value
+            else:
+                scalars[name] = int(value)
+    if 'diameters' in outputs:
+        for name, value in outputs['diameters'].items():
+            arrays['diameters/' + name] = value
+
+    source = getattr(volume_data, 'source', None)
+    index = {'version': VERSION,
+             'source': None if source is None else {
+                 'path': os.path.abspath(source),
+                 'key': source_key(source) if os.path.exists(source)
+                 else None},
+             'params': {'pixel_size': volume_data.pixel_size,
+                        'spacing': volume_data.spacing,
+                        'distance_precision':
+                            volume_data.distance_precision,
+                        'thinning': volume_data.thinning,
+                        'packed_masks': volume_data.packed_masks,
+                        'exclude_edges': volume_data.exclude_edges,
+                        'tile_shape': volume_data.tile_shape,
+                        'halo': volume_data.halo,
+                        'processes': volume_data.processes},
+             'stages': sorted(outputs),
+             'diameter_table': scalars,
+             'distance_scale': distance_scale,
+             'shape': list(volume_data.shape),
+             'sections': sections}
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', 0))
+            for name, volume in volumes.items():
+                packed, shape = _packed_bytes(volume)
+                entry = _write_chunked(f, packed)
+                entry.update(dtype=packed.dtype.str,
+                             shape=list(packed.shape),
+                             volume_shape=list(shape))
+                sections['volume/' + name] = entry
+            for name, field in fields.items():
+                entry = _write_chunked(f, field)
+                entry.update(dtype=np.dtype(field.dtype).str,
+                             shape=list(field.shape))
+                sections[name] = entry
+            for name, array in arrays.items():
+                array = np.asarray(array)
+                entry = _write_raw(f, array)
+                entry.update(dtype=array.dtype.str, shape=list(array.shape))
+                sections[name] = entry
+            offset = f.tell()
+            f.write(json.dumps(index, sort_keys=True).encode())
+            f.seek(len(MAGIC))
+            f.write(struct.pack('<Q', offset))
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return path
+
+
+def read_index(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a project file'.format(path))
+        offset, = struct.unpack('<Q', f.read(8))
+        f.seek(offset)
+        return json.loads(f.read().decode())
+
+
+def open_section(path, entry):
+    """Returns a section: a memory map for raw sections, a ChunkedArray for
+    compressed ones."""
+    shape = tuple(entry['shape'])
+    if entry['encoding'] == 'zlib':
+        return ChunkedArray(path, entry)
+    if not int(np.prod(shape)):
+        return np.zeros(shape, dtype=entry['dtype'])
+    return np.memmap(path, dtype=entry['dtype'], mode='r',
+                     offset=entry['offset'], shape=shape)
+
+
+def load_project(path, **widgets):
+    """Opens a project file as a VolumeData ready to browse or export.
+
+    Volumes stay compressed on disk until sliced and the skeleton tables
+    are memory-mapped; every saved stage is restored into the stage cache,
+    so calculate() only copies results.  widgets are passed to VolumeData
+    (status, progress, display, plot).
+    """
+    index = read_index(path)
+    if index.get('version') != VERSION:
+        raise ValueError('unsupported project version')
+    sections = index['sections']
+
+    def volume(name):
+        entry = sections['volume/' + name]
+        return PackedVolume(open_section(path, entry), entry['volume_shape'])
+
+    def group(prefix):
+        return dict((name[len(prefix):], open_section(path, entry))
+                    for name, entry in sections.items()
+                    if name.startswith(prefix))
+
+    params = index['params']
+    data = VolumeData(volume('im'), params['pixel_size'], **widgets)
+    spacing = params.get('spacing')
+    data.spacing = None if spacing is None else tuple(spacing)
+    data.distance_precision = params.get('distance_precision', 'float64')
+    data.thinning = params.get('thinning', 'skimage')
+    data.packed_masks = params['packed_masks']
+    data.exclude_edges = params['exclude_edges']
+    data.tile_shape = params['tile_shape']
+    data.halo = params['halo']
+    data.processes = params['processes']
+    source = index.get('source')
+    data.source = source['path'] if source else None
+
+    def mask(name):
+        mask = volume(name)
+        return mask if data.packed_masks else np.asarray(mask)
+
+    outputs = {}
+    stages = index['stages']
+    if 'skeleton' in stages:
+        outputs['skeleton'] = {
+            'coords': open_section(path, sections['skeleton/coords']),
+            'timings': None}
+    if 'distance' in stages:
+        distance = open_section(path, sections['distance'])
+        scale = index.get('distance_scale')
+        outputs['distance'] = distance if scale is None else \
+            SquaredDistance(distance, scale)
+    if 'graph' in stages:
+        arrays = group('graph/')
+        pairs = arrays.pop('pairs')
+        outputs['graph'] = SkeletonGraph.from_arrays(
+            index['shape'], arrays, (pairs[0], pairs[1]))
+    if 'masks' in stages:
+        outputs['masks'] = tuple(mask(name) for name in
+                                 ('skel', 'nodes', 'terminal'))
+    if 'node_mask' in stages:
+        outputs['node_mask'] = mask('node_mask')
+    for name in ('edge_lengths', 'lengths'):
+        if name in stages:
+            outputs[name] = open_section(path, sections[name])
+    if 'diameter_table' in stages:
+        table = group('diameter_table/')
+        table.update(index['diameter_table'])
+        outputs['diameter_table'] = table
+    if 'diameters' in stages:
+        outputs['diameters'] = group('diameters/')
+    data.restore(outputs)
+    if 'diameters' in stages:
+        data.calculate(data.tile_shape, data.halo)
+    return data
+
+
+def is_project(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
@@ -0,0 +1,76 @@
+"""Resampling of boolean volumes without converting them to float.
+
+Output voxels are mapped to input voxels with integer index maps, one per
+axis, and the volume is processed in slabs along the first axis, so the
+input may be a lazy TiffVolume or PackedVolume and the output can be
+bit-packed.
+"""
+import numpy as np
+
+from .packed import PackedVolume
+
+
+def index_map(n_in, n_out):
+    """Returns the input index nearest to the center of each output voxel."""
+    centers = (np.arange(n_out) + 0.5) * (float(n_in) / n_out)
+    return np.minimum(centers.astype(np.intp), n_in - 1)
+
+
+def bin_edges(n_in, n_out):
+    """Returns the first input index of each output voxel (plus n_in) when
+    shrinking an axis; every bin holds at least one input voxel."""
+    return np.round(np.arange(n_out + 1) * (float(n_in) / n_out)).astype(
+        np.intp)
+
+
+def resample_binary(im, output_shape, method='nearest', slab=32,
+                    packed=False):
+    """Resamples a bool volume to output_shape.
+
+    method 'nearest' takes the input voxel under each output voxel center.
+    'majority' sets an output voxel when at least half of the input voxels
+    it covers are set, along the axes that shrink (growing axes use the
+    nearest voxel).  Only the input rows of one output slab of slab
+    voxels are held at a time.  Returns a bool array, or a PackedVolume
+    with packed=True.
+    """
+    shape = tuple(im.shape)
+    output_shape = tuple(int(i) for i in output_shape)
+    if method not in ('nearest', 'majority'):
+        raise ValueError('unknown resampling method: {}'.format(method))
+    if packed:
+        out = PackedVolume.zeros(output_shape)
+    else:
+        out = np.zeros(output_shape, dtype='bool')
+    shrink = [method == 'majority' and m < n
+              for n, m in zip(shape, output_shape)]
+    maps = [bin_edges(n, m) if s else index_map(n, m)
+            for n, m, s in zip(shape, output_shape, shrink)]
+    for start in range(0, output_shape[0], slab):
+        stop = min(start + slab, output_shape[0])
+        if shrink[0]:
+            lo, hi = maps[0][start], maps[0][stop]
+        else:
+            rows = maps[0][start:stop]
+            lo, hi = rows[0], rows[-1] + 1
+        block = np.asarray(im[lo:hi], dtype='bool')
+        if not any(shrink):
+            out[start:stop] = block[np.ix_(rows - lo, maps[1], maps[2])]
+            continue
+        # votes and voxel counts per output voxel
+        votes = block.astype(np.uint32)
+        sizes = np.ones((1, 1, 1), dtype=np.uint32)
+        for axis in range(3):
+            if shrink[axis]:
+                edges = maps[axis]
+                if axis == 0:
+                    edges = edges[start:stop + 1] - lo
+                votes = np.add.reduceat(votes, edges[:-1], axis=axis)
+                size = np.diff(edges).astype(np.uint32)
+                sizes = sizes * size.reshape(
+                    [-1 if i == axis else 1 for i in range(3)])
+            else:
+                index = maps[axis] if axis else rows - lo
+                votes = np.take(votes, index, axis=axis)
+        out[start:stop] = 2 * votes >= sizes
+    return out
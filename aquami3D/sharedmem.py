@@ -0,0 +1,64 @@
+"""Numpy arrays in named shared memory for process pool workers."""
+import multiprocessing as mp
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedArray(object):
+    # A numpy array backed by a named shared memory block.  The creating
+    # process owns the block and unlinks it; workers attach by spec().
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(int(i) for i in shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = _attach(name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype,
+                                buffer=self.shm.buf)
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        return cls(shape, dtype, name)
+
+    def spec(self):
+        # Picklable description that workers pass to attach().
+        return self.shm.name, self.shape, self.dtype.str
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def process_pool(processes=None, initializer=None, initargs=()):
+    """Returns a multiprocessing.Pool whose workers can attach SharedArrays.
+
+    On POSIX the resource tracker is started first so the workers share it
+    with this process.  Otherwise a worker that attaches a block starts its
+    own tracker, which unlinks the block when the worker exits.
+    """
+    if os.name == 'posix':
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+    return mp.Pool(processes, initializer, initargs)
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: # Python < 3.13 has no track argument
+        return shared_memory.SharedMemory(name=name)
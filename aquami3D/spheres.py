@@ -0,0 +1,110 @@
+"""Sphere footprints as voxel offsets, with a bounded cache.
+
+Stamping a sphere around a list of voxels is a broadcast add of the
+offsets to the coordinates, so there is no convolution with a dense ball.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Default byte budget of a SphereCache.
+DEFAULT_BUDGET = 64 * 1024 * 1024
+
+
+def sphere_offsets(radius):
+    """Returns the (n, 3) integer offsets within radius voxels of a voxel."""
+    r = int(np.floor(radius))
+    grid = np.mgrid[-r:r + 1, -r:r + 1, -r:r + 1].reshape((3, -1)).T
+    return grid[(grid ** 2).sum(axis=1) <= radius ** 2]
+
+
+def sphere_mask(radius):
+    """Returns the dense bool ball of radius, like morphology.ball."""
+    r = int(np.floor(radius))
+    grid = np.mgrid[-r:r + 1, -r:r + 1, -r:r + 1]
+    return (grid ** 2).sum(axis=0) <= radius ** 2
+
+
+class SphereCache(object):
+    """Least recently used cache of sphere footprints.
+
+    offsets(radius) returns the sparse offsets of sphere_offsets and
+    mask(radius) the dense ball of sphere_mask.  Entries are read-only
+    arrays; the least recently used ones are dropped once their total size
+    exceeds budget bytes (the newest entry is always kept).  The cache can
+    be shared between threads: every access holds a lock, and a missing
+    sphere is built outside it.
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def offsets(self, radius):
+        return self._get(('offsets', float(radius)), sphere_offsets)
+
+    def mask(self, radius):
+        return self._get(('mask', float(radius)), sphere_mask)
+
+    def _get(self, key, build):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = build(key[1])
+        if value.dtype != bool:
+            value = value.astype(np.int16)
+        value.setflags(write=False)
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = value
+                self.nbytes += value.nbytes
+                while self.nbytes > self.budget and len(self._items) > 1:
+                    _, old = self._items.popitem(last=False)
+                    self.nbytes -= old.nbytes
+            return self._items.get(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def __contains__(self, radius):
+        with self._lock:
+            key = float(radius)
+            return (('offsets', key) in self._items
+                    or ('mask', key) in self._items)
+
+
+# Cache shared by the module functions and the voxelizers.
+spheres = SphereCache()
+
+
+def stamp(out, coords, radius, cache=None, chunk=1 << 20):
+    """Sets the voxels of out within radius of every voxel in coords.
+
+    coords are (3, n) voxel coordinates.  Offsets outside out are dropped.
+    At most chunk voxels are stamped per vectorized step.
+    """
+    offsets = (spheres if cache is None else cache).offsets(radius)
+    coords = np.asarray(coords, dtype=np.intp)
+    upper = np.array(out.shape)[:, None]
+    step = max(chunk // len(offsets), 1)
+    for i in range(0, coords.shape[1], step):
+        near = (coords[:, i:i + step, None]
+                + offsets.T[:, None, :]).reshape((3, -1))
+        near = near[:, np.all((near >= 0) & (near < upper), axis=0)]
+        out[tuple(near)] = 1
+    return out
@@ -0,0 +1,236 @@
+"""Parallel 3D thinning, an alternative to skimage's skeletonize_3d.
+
+Both follow Lee et al. (1994): in six sub-iterations, one per direction,
+the border voxels that are not end points, keep the Euler characteristic
+and leave their 26-neighbors connected are deleted, until no direction
+deletes anything.  skeletonize_3d rescans the volume every sub-iteration
+and re-checks the candidates one at a time.  Here:
+
+* only an active list of surface voxels (foreground voxels with a
+  background face neighbor) is examined, updated from the deleted voxels;
+* the 26-neighborhood of a voxel is a 26 bit code, built in chunks on a
+  thread pool; the end point, Euler and connectivity tests are bit
+  operations on arrays of codes, and their result is kept per code in a
+  shared table, so each configuration is tested once;
+* the candidates are re-checked for simplicity (as skeletonize_3d does,
+  plus the Euler test) in 8 subfields of voxel coordinate parities.
+  Voxels of one subfield are not neighbors, so each subfield is
+  re-checked and deleted in one step.
+
+The result is a topology-equivalent skeleton; voxels may differ from
+skeletonize_3d where the order of deletion does.  Unlike skeletonize_3d,
+thin never deletes the last voxel of a component: skeletonize_3d erases
+small components on the volume border, e.g. 4 of the 33 of the example
+stack (Euler number -876 instead of the input's -872), while thin keeps
+the components and Euler number of the input.
+"""
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Offsets of the 26 neighbors; bit k of a neighborhood code is neighbor k.
+NEIGHBORS = [o for o in itertools.product((-1, 0, 1), repeat=3) if any(o)]
+# Border directions in the order of skeletonize_3d.
+DIRECTIONS = ((0, -1, 0), (0, 1, 0), (0, 0, 1), (0, 0, -1), (1, 0, 0),
+              (-1, 0, 0))
+# Candidates per thread task.
+CHUNK = 1 << 16
+
+
+def _bits(offsets):
+    return sum(1 << NEIGHBORS.index(o) for o in offsets)
+
+
+def _cell_mask(cell):
+    # Neighbors whose closed cube contains a face, edge or vertex of the
+    # center cube; cell is the offset of that face, edge or vertex.
+    return _bits(o for o in NEIGHBORS
+                 if all(a in (0, c) for a, c in zip(o, cell)))
+
+
+# Masks of the neighbors covering every face, edge and vertex of the center.
+_CELLS = [[_cell_mask(o) for o in NEIGHBORS
+           if sum(map(abs, o)) == n] for n in (1, 2, 3)]
+# Neighbors 26-adjacent to every neighbor.
+_ADJACENT = [_bits(q for q in NEIGHBORS if q != o and
+                   max(abs(a - b) for a, b in zip(o, q)) <= 1)
+             for o in NEIGHBORS]
+
+
+# OR of the adjacency masks of the neighbors set in each byte of a code.
+_GROW = [np.array([np.bitwise_or.reduce(
+    [_ADJACENT[8 * i + k] for k in range(8)
+     if b >> k & 1 and 8 * i + k < len(NEIGHBORS)] or [0])
+    for b in range(256)], dtype=np.int32) for i in range(4)]
+
+
+def _unique(values):
+    # Sorted distinct values (np.unique hashes, which is slower here).
+    values = np.sort(values)
+    return values[np.concatenate((values[:1] == values[:1],
+                                  values[1:] != values[:-1]))]
+
+
+def is_endpoint(codes):
+    return (codes != 0) & ((codes & (codes - 1)) == 0)
+
+
+def is_euler_invariant(codes):
+    """Deleting the voxel keeps the Euler characteristic: the part of its
+    closed cube covered by its neighbors has Euler characteristic 1."""
+    euler = np.zeros(codes.shape, dtype=np.int8)
+    for sign, masks in zip((1, -1, 1), _CELLS):
+        for mask in masks:
+            euler += sign * ((codes & mask) != 0)
+    return euler == 1
+
+
+def is_connected(codes):
+    """The neighbors form one 26-connected component, found by growing the
+    lowest neighbor through the adjacency masks, a byte at a time."""
+    reached = codes & -codes
+    while True:
+        grown = reached | _GROW[0][reached & 255]
+        for i in range(1, 4):
+            grown |= _GROW[i][(reached >> 8 * i) & 255]
+        grown &= codes
+        if np.array_equal(grown, reached):
+            return (reached == codes) & (codes != 0)
+        reached = grown
+
+
+def is_simple(codes):
+    return is_euler_invariant(codes) & is_connected(codes)
+
+
+def is_deletable(codes):
+    return ~is_endpoint(codes) & is_simple(codes)
+
+
+class CodeTable(object):
+    """Result of test for every neighborhood code seen so far, as two bits
+    per code (known, value), 16 MB in all.  Lookups and updates hold a
+    lock; the tests of new codes run outside it."""
+
+    def __init__(self, test):
+        self.test = test
+        self._known = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    def lookup(self, codes):
+        with self._lock:
+            if self._known is None:
+                size = 1 << (len(NEIGHBORS) - 3)
+                self._known = np.zeros(size, dtype=np.uint8)
+                self._value = np.zeros(size, dtype=np.uint8)
+            missing = codes[~self._test(self._known, codes)]
+        if len(missing):
+            missing = _unique(missing)
+            values = self.test(missing)
+            with self._lock:
+                self._set(self._value, missing[values])
+                self._set(self._known, missing)
+        with self._lock:
+            return self._test(self._value, codes)
+
+    @staticmethod
+    def _test(bits, codes):
+        return (bits[codes >> 3] >> (codes & 7) & 1).astype('bool')
+
+    @staticmethod
+    def _set(bits, codes):
+        np.bitwise_or.at(bits, codes >> 3, (1 << (codes & 7)).astype(
+            np.uint8))
+
+    def clear(self):
+        with self._lock:
+            self._known = self._value = None
+
+
+# Tables shared by every thinning.
+deletable_codes = CodeTable(is_deletable)
+simple_codes = CodeTable(is_simple)
+
+
+class Thinning(object):
+    """Thins one volume; see thin()."""
+
+    def __init__(self, im, workers=None):
+        self.shape = tuple(n + 2 for n in im.shape)
+        # zero padded, so every voxel of the volume has 26 neighbors;
+        # voxels of the active list are 2
+        self.img = np.zeros(self.shape, dtype=np.uint8)
+        self.img[1:-1, 1:-1, 1:-1] = np.asarray(im, dtype='bool')
+        self.flat = self.img.reshape(-1)
+        strides = np.array([self.shape[1] * self.shape[2], self.shape[2], 1])
+        self.offsets = np.array(NEIGHBORS).dot(strides)
+        self.steps = [int(np.dot(d, strides)) for d in DIRECTIONS]
+        self.faces = np.array([int(np.dot(d, strides)) for d in NEIGHBORS
+                               if sum(map(abs, d)) == 1])
+        self.workers = workers
+        index = np.flatnonzero(self.flat)
+        border = np.zeros(len(index), dtype='bool')
+        for step in self.faces:
+            border |= self.flat[index + step] == 0
+        self.active = index[border]
+        self.flat[self.active] = 2
+
+    def codes(self, index):
+        codes = np.zeros(len(index), dtype=np.int32)
+        for k, offset in enumerate(self.offsets):
+            codes |= (self.flat[index + offset] != 0).astype(np.int32) << k
+        return codes
+
+    def select(self, index, table, pool):
+        # Voxels of index whose code passes table, in chunks on the pool.
+        if len(index) <= CHUNK:
+            return index[table.lookup(self.codes(index))]
+        chunks = [index[i:i + CHUNK] for i in range(0, len(index), CHUNK)]
+        return np.concatenate(list(pool.map(
+            lambda chunk: chunk[table.lookup(self.codes(chunk))], chunks)))
+
+    def subiteration(self, step, pool):
+        """Deletes the simple border voxels facing step; returns how many."""
+        index = self.active[self.flat[self.active + step] == 0]
+        index = self.select(index, deletable_codes, pool)
+        if not len(index):
+            return 0
+        coords = np.unravel_index(index, self.shape)
+        field = (coords[0] & 1) * 4 + (coords[1] & 1) * 2 + (coords[2] & 1)
+        deleted = []
+        for parity in range(8):
+            part = index[field == parity]
+            part = self.select(part, simple_codes, pool)
+            self.flat[part] = 0
+            deleted.append(part)
+        deleted = np.concatenate(deleted)
+        if len(deleted):
+            # foreground face neighbors of deleted voxels join the surface
+            near = (deleted[:, None] + self.faces).ravel()
+            near = _unique(near[self.flat[near] == 1])
+            self.flat[near] = 2
+            self.active = np.concatenate(
+                [self.active[self.flat[self.active] != 0], near])
+        return len(deleted)
+
+    def run(self):
+        with ThreadPoolExecutor(self.workers) as pool:
+            unchanged = 0
+            while unchanged < len(self.steps):
+                unchanged = 0
+                for step in self.steps:
+                    if not self.subiteration(step, pool):
+                        unchanged += 1
+        return self.img[1:-1, 1:-1, 1:-1].astype('bool')
+
+
+def thin(im, workers=None):
+    """Returns the bool skeleton of a 3D volume.
+
+    workers is the number of threads (None for the ThreadPoolExecutor
+    default).
+    """
+    return Thinning(im, workers).run()
@@ -0,0 +1,183 @@
+"""Lazy, memory-mapped access to TIFF stacks."""
+import numpy as np
+import tifffile
+
+from .packed import PackedVolume
+
+# Compression tag value of uncompressed data.
+_NONE = 1
+
+
+class TiffVolume(object):
+    """Read-on-demand view of a TIFF stack.
+
+    Indexing returns the same thresholded, axis-swapped bool volume as
+    inout.read_tiff_stack, i.e. axes (columns, rows, pages), but only the
+    pages and sub-rectangles inside the requested slices are read.
+    Uncompressed strips and tiles are memory-mapped; compressed pages are
+    decoded one at a time.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = str(file_path)
+        try:
+            self.tif = tifffile.TiffFile(self.file_path)
+        except ValueError as e: # TiffFileError: not a TIFF file
+            raise OSError(str(e))
+        series = self.tif.series[0]
+        self.pages = series.pages
+        self.keyframe = series.keyframe
+        self.dtype = series.dtype.newbyteorder(self.tif.byteorder)
+        self.samples = self.keyframe.samplesperpixel
+        shape = series.shape if self.samples == 1 else series.shape[:-1]
+        if len(shape) == 2:
+            shape = (1,) + shape
+        self.pages_shape = tuple(int(i) for i in shape[-3:]) # z, y, x
+        self.shape = self.pages_shape[::-1]
+        self.ndim = 3
+        self._map = np.memmap(self.file_path, dtype=np.uint8, mode='r')
+        self._series = None
+        offset = getattr(series, 'dataoffset', None)
+        if offset is not None and self._mappable(self.keyframe):
+            # contiguous, uncompressed series (also >4 GB ImageJ stacks
+            # that only store the first page)
+            count = int(np.prod(series.shape)) * self.dtype.itemsize
+            self._series = self._map[offset:offset + count].view(
+                self.dtype).reshape(self.pages_shape + (self.samples,))
+
+    def _mappable(self, page):
+        return (page.compression == _NONE and page.fillorder == 1
+                and page.bitspersample in (8, 16, 32, 64)
+                and (self.samples == 1 or page.planarconfig == 1))
+
+    def __getitem__(self, key):
+        (x, y, z), drop = _normalize(key, self.shape)
+        out = np.zeros((len(range(*z.indices(self.shape[2]))),
+                        len(range(*y.indices(self.shape[1]))),
+                        len(range(*x.indices(self.shape[0])))), dtype='bool')
+        rows = slice(*y.indices(self.shape[1])[:2])
+        cols = slice(*x.indices(self.shape[0])[:2])
+        if out.size:
+            for i, page in enumerate(range(*z.indices(self.shape[2]))):
+                region = self.read_region(page, rows, cols)
+                out[i] = region[::y.step or 1, ::x.step or 1] > 0
+        out = np.swapaxes(out, 0, 2)
+        return out[tuple(0 if i else slice(None) for i in drop)]
+
+    def __array__(self, dtype=None, copy=None):
+        volume = self[:, :, :]
+        return volume if dtype is None else volume.astype(dtype)
+
+    def pack(self):
+        """Returns the whole stack as a PackedVolume.
+
+        Pages are read eight at a time, one packed byte along the page axis,
+        so the full bool volume is never held.
+        """
+        cols, rows, depth = self.shape
+        volume = PackedVolume.zeros(self.shape)
+        for start in range(0, depth, 8):
+            pages = np.zeros((8, rows, cols), dtype='bool')
+            for i in range(start, min(start + 8, depth)):
+                pages[i - start] = self.read_region(i, slice(0, rows),
+                                                    slice(0, cols)) > 0
+            volume.packed[:, :, start // 8] = np.packbits(pages.T, axis=-1)[
+                ..., 0]
+        return volume
+
+    def read_region(self, index, rows, cols):
+        """Returns the raw (rows, cols) region of one page.
+
+        rows and cols are slices with positive unit steps.  Samples of RGB
+        pages are reduced with max.
+        """
+        if self._series is not None:
+            region = self._series[index, rows, cols]
+        else:
+            page = self.pages[index]
+            if not self._mappable(self.keyframe):
+                region = page.asarray()
+                if self.samples > 1 and self.keyframe.planarconfig == 2:
+                    region = np.moveaxis(region, 0, -1)
+                region = region.reshape(region.shape[:2] + (-1,))[rows, cols]
+            elif self.keyframe.is_tiled:
+                region = self._read_tiles(page, rows, cols)
+            else:
+                region = self._read_strips(page, rows, cols)
+        return region.max(axis=-1) if region.shape[-1] > 1 else region[..., 0]
+
+    def _segment(self, page, index, shape):
+        # Memory-maps one uncompressed strip or tile.
+        offset = page.dataoffsets[index]
+        count = int(np.prod(shape)) * self.dtype.itemsize
+        return self._map[offset:offset + count].view(self.dtype).reshape(
+            shape)
+
+    def _read_strips(self, page, rows, cols):
+        height, width = self.pages_shape[1:]
+        per_strip = min(self.keyframe.rowsperstrip, height)
+        r0, r1 = rows.start, rows.stop
+        region = np.empty((r1 - r0, cols.stop - cols.start, self.samples),
+                          dtype=self.dtype)
+        for strip in range(r0 // per_strip, (r1 - 1) // per_strip + 1):
+            top = strip * per_strip
+            n = min(per_strip, height - top)
+            data = self._segment(page, strip, (n, width, self.samples))
+            a, b = max(r0, top), min(r1, top + n)
+            region[a - r0:b - r0] = data[a - top:b - top, cols]
+        return region
+
+    def _read_tiles(self, page, rows, cols):
+        width = self.pages_shape[2]
+        th, tw = self.keyframe.tilelength, self.keyframe.tilewidth
+        across = -(-width // tw)
+        r0, r1, c0, c1 = rows.start, rows.stop, cols.start, cols.stop
+        region = np.empty((r1 - r0, c1 - c0, self.samples), dtype=self.dtype)
+        for ty in range(r0 // th, (r1 - 1) // th + 1):
+            for tx in range(c0 // tw, (c1 - 1) // tw + 1):
+                data = self._segment(page, ty * across + tx,
+                                     (th, tw, self.samples))
+                top, left = ty * th, tx * tw
+                a, b = max(r0, top), min(r1, top + th)
+                c, d = max(c0, left), min(c1, left + tw)
+                region[a - r0:b - r0, c - c0:d - c0] = \
+                    data[a - top:b - top, c - left:d - left]
+        return region
+
+    def close(self):
+        self._series = None
+        self._map = None
+        self.tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _normalize(key, shape):
+    # Turns an index into three slices plus flags marking integer indices,
+    # whose axes are dropped from the result.
+    if not isinstance(key, tuple):
+        key = (key,)
+    if Ellipsis in key:
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None),) * (4 - len(key)) + key[i + 1:]
+    key = key + (slice(None),) * (3 - len(key))
+    if len(key) > 3:
+        raise IndexError('too many indices for a 3D volume')
+    slices, drop = [], []
+    for k, n in zip(key, shape):
+        if isinstance(k, slice):
+            if k.step is not None and k.step < 1:
+                raise IndexError('TiffVolume only supports positive steps')
+            slices.append(k)
+            drop.append(False)
+        else:
+            k = int(k) + n if int(k) < 0 else int(k)
+            if not 0 <= k < n:
+                raise IndexError('index out of range')
+            slices.append(slice(k, k + 1))
+            drop.append(True)
+    return slices, drop
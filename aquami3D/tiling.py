@@ -0,0 +1,164 @@
+"""Tiled, out-of-core skeletonization.
+
+The volume is cut into tiles that are processed one at a time, each read
+with a halo of surrounding voxels so the skeleton near its faces sees the
+same structure as in the whole volume.  Only the skeleton voxels of every
+tile are kept, as coordinate lists; the skeleton graph built from all of
+them (see VolumeData) joins ligaments across the tile seams.  The working
+set is one haloed tile plus the skeleton, so the volume itself may be a
+lazy TiffVolume or a memory-mapped PackedVolume much larger than memory.
+
+Tiles are independent, so they can also be farmed out to a process pool:
+the workers read their tiles from a bit-packed copy of the volume in shared
+memory (or reopen a TIFF stack) and send back only the skeleton voxels.
+"""
+import time
+
+import numpy as np
+
+from . import measure
+from .distance import distance_field
+from .packed import PackedVolume
+from .sharedmem import SharedArray, process_pool
+from .tiff import TiffVolume
+
+DEFAULT_TILE = (128, 128, 128)
+# Starting halo in voxels.  It grows whenever a tile holds a ligament
+# whose diameter is larger than the halo.
+DEFAULT_HALO = 16
+
+
+def tile_grid(shape, tile_shape=DEFAULT_TILE):
+    """Returns the slices of the tiles that cover a volume, in C order."""
+    starts = [range(0, n, t) for n, t in zip(shape, tile_shape)]
+    return [tuple(slice(a, min(a + t, n)) for a, t, n in
+                  zip((x, y, z), tile_shape, shape))
+            for x in starts[0] for y in starts[1] for z in starts[2]]
+
+
+def with_halo(tile, shape, halo):
+    """Returns the tile grown by halo voxels (clipped to the volume) and
+    the slices of the tile inside the grown block."""
+    outer = tuple(slice(max(s.start - halo, 0), min(s.stop + halo, n))
+                  for s, n in zip(tile, shape))
+    inner = tuple(slice(s.start - o.start, s.stop - o.start)
+                  for s, o in zip(tile, outer))
+    return outer, inner
+
+
+def process_block(block, inner, thinning='skimage'):
+    """Skeletonizes a haloed block and returns the skeleton of its tile.
+
+    Returns a dict with the tile coordinates of the skeleton voxels
+    ('coords') and the largest distance to the background in the tile, in
+    voxels ('max_dt'), which sizes the halo.  thinning is the method of
+    measure.skeletonize.
+    """
+    skel = measure.skeletonize(block, thinning)[inner]
+    dt = distance_field(block, precision='float32')[inner]
+    max_dt = float(dt.max()) if dt.size else 0.0
+    return {'coords': np.array(np.nonzero(skel)), 'max_dt': max_dt}
+
+
+def read_tile(im, tile, halo, thinning='skimage'):
+    """Processes one tile of im, growing halo until the block holds twice
+    the largest ligament radius of the tile.  Returns (result, halo)."""
+    while True:
+        outer, inner = with_halo(tile, im.shape, halo)
+        block = np.asarray(im[outer], dtype='bool')
+        result = process_block(block, inner, thinning)
+        if result['max_dt'] * 2 <= halo:
+            return result, halo
+        halo = int(np.ceil(result['max_dt'] * 2)) + 2
+
+
+def time_tile(im, tile, halo, thinning='skimage'):
+    # read_tile that also records the tile and its wall time.
+    start = time.perf_counter()
+    result, halo = read_tile(im, tile, halo, thinning)
+    result['tile'] = tile
+    result['seconds'] = time.perf_counter() - start
+    return result, halo
+
+
+def share_volume(im):
+    """Returns (shared, source) for handing im to worker processes.
+
+    shared is a SharedArray holding im bit-packed, owned by the caller, or
+    None for a TiffVolume, which the workers reopen from its file.  source
+    is the picklable description passed to the pool initializer.
+    """
+    if isinstance(im, TiffVolume):
+        return None, ('tiff', im.file_path)
+    packed = PackedVolume.pack(im)
+    shared = SharedArray(packed.packed.shape, np.uint8)
+    shared.array[...] = packed.packed
+    return shared, ('packed', shared.spec(), packed.shape)
+
+
+# Volume opened by every pool worker in _init_worker, and the shared
+# memory behind it, which must stay referenced while the volume is used.
+_worker_volume = None
+_worker_shared = None
+
+
+def _init_worker(source):
+    global _worker_volume, _worker_shared
+    if source[0] == 'tiff':
+        _worker_volume = TiffVolume(source[1])
+    else:
+        _worker_shared = SharedArray.attach(source[1])
+        _worker_volume = PackedVolume(_worker_shared.array, source[2])
+
+
+def _run_tile(job):
+    index, tile, halo, thinning = job
+    return index, time_tile(_worker_volume, tile, halo, thinning)[0]
+
+
+def tiled_skeleton(im, tile_shape=DEFAULT_TILE, halo=None, progress=None,
+                   processes=1, thinning='skimage'):
+    """Skeletonizes im tile by tile.
+
+    Returns (coords, timings): the (3, n) skeleton voxels in C order and
+    the (tile, seconds) wall time of every tile.  im may be any 3D volume
+    that returns bool arrays when sliced.  halo is the starting halo in
+    voxels; it is doubled past the largest ligament radius seen so far.
+    With processes other than 1 the tiles run in a process pool (None for
+    one process per CPU).  progress(done, total) is called after every
+    tile.  thinning is the method of measure.skeletonize.
+    """
+    shape = tuple(im.shape)
+    halo = DEFAULT_HALO if halo is None else halo
+    tiles = tile_grid(shape, tile_shape)
+    parts = [None] * len(tiles)
+    if processes == 1:
+        for done, tile in enumerate(tiles):
+            parts[done], halo = time_tile(im, tile, halo, thinning)
+            if progress is not None:
+                progress(done + 1, len(tiles))
+    else:
+        shared, source = share_volume(im)
+        try:
+            with process_pool(processes, _init_worker, (source,)) as pool:
+                jobs = [(i, tile, halo, thinning)
+                        for i, tile in enumerate(tiles)]
+                for done, (i, part) in enumerate(
+                        pool.imap_unordered(_run_tile, jobs)):
+                    parts[i] = part
+                    if progress is not None:
+                        progress(done + 1, len(tiles))
+        finally:
+            if shared is not None:
+                shared.close()
+    return merge_parts(shape, parts)
+
+
+def merge_parts(shape, parts):
+    """Returns (coords, timings) of the per-tile results, the coordinates
+    in C order of the volume."""
+    coords = np.concatenate(
+        [p['coords'] + np.array([s.start for s in p['tile']])[:, None]
+         for p in parts], axis=1)
+    order = np.argsort(np.ravel_multi_index(coords, shape), kind='stable')
+    return coords[:, order], [(p['tile'], p['seconds']) for p in parts]
@@ -6,8 +6,6 @@ import vtk
 import numpy as np
 import matplotlib
 matplotlib.use('Qt5Agg')
-from scipy.stats import lognorm, norm
-from scipy import ndimage
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5 import Qt
 
@@ -16,7 +14,7 @@ from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 
-from inout import *
+from .packed import unpack
 
 class MainWindow(Qt.QMainWindow):
 
@@ -27,6 +25,7 @@ class MainWindow(Qt.QMainWindow):
 
 def get_edges(im):
     # Takes a 3D volume and returns just the edge pixels that boarder 0 values.
+    from scipy import ndimage
     struct = ndimage.generate_binary_structure(3, 3)
     mask = im > 0
     erode = ndimage.binary_erosion(mask, struct)
@@ -56,6 +55,10 @@ class VtkWindow(QtWidgets.QWidget):
         if self.volume is not None:
             self.ren.RemoveVolume(self.volume)
 
+        # bit-packed volumes are unpacked here, after any slicing
+        im, skel, nodes, term, node_mask = [
+            unpack(i) for i in (im, skel, nodes, term, node_mask)]
+
         if im is not None:
             matrix = np.zeros(im.shape)
         elif skel is not None:
@@ -167,7 +170,7 @@ class VtkWindow(QtWidgets.QWidget):
             self.ren.RemoveVolume(self.volume)
 
         # Change the volume numpy matrix to a VTK-image
-        matrix = matrix.astype(np.uint16)
+        matrix = unpack(matrix).astype(np.uint16)
         dataImporter = vtk.vtkImageImport()
         data_string = matrix.tostring()
         dataImporter.CopyImportVoidPointer(data_string, len(data_string))
@@ -247,7 +250,7 @@ class VtkWindow(QtWidgets.QWidget):
         # Setup image volume
         if im is not None:
             # Change the volume numpy matrix to a VTK-image
-            im = im.astype(np.uint16)
+            im = unpack(im).astype(np.uint16)
             dataImporter = vtk.vtkImageImport()
             data_string = im.tostring()
             dataImporter.CopyImportVoidPointer(data_string, len(data_string))
@@ -292,7 +295,7 @@ class VtkWindow(QtWidgets.QWidget):
         # Setup skeletal
         if skel is not None:
             # Change the volume numpy matrix to a VTK-image
-            skel = skel.astype(np.uint16)
+            skel = unpack(skel).astype(np.uint16)
             dataImporter = vtk.vtkImageImport()
             data_string = skel.tostring()
             dataImporter.CopyImportVoidPointer(data_string, len(data_string))
@@ -379,6 +382,7 @@ class PlotCanvas(FigureCanvas):
                 numBins = 1
 
         n, bins, patches = self.axes.hist(data, bins=numBins, density=1, edgecolor='black')
+        from scipy.stats import norm
         gfit = norm.fit(data.flatten())
         gauss_plot = norm.pdf(bins, gfit[0], gfit[1])
         self.axes.plot(bins, gauss_plot, 'r--', linewidth=1, label='gaussian')
@@ -0,0 +1,375 @@
+"""Block-vectorized readers for OVITO extended XYZ atom dumps."""
+import io
+import multiprocessing as mp
+import os
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from .sharedmem import SharedArray, process_pool
+from .cache import source_key
+
+# Bytes read from disk per block.
+BLOCK_SIZE = 16 * 1024 * 1024
+
+# Smallest byte range handed to a worker by the parallel loader.
+MIN_CHUNK_SIZE = 4 * 1024 * 1024
+
+# numpy 1.23 replaced the pure Python loadtxt with a C parser that is
+# several times faster than converting split tokens.
+_C_LOADTXT = np.lib.NumpyVersion(np.__version__) >= '1.23.0'
+
+# A blank (or whitespace only) line, matched from the newline before it.
+_BLANK_LINE = re.compile(br'\n[ \t\r\f\v]*(?=\n)')
+
+XYZHeader = namedtuple('XYZHeader', 'n_atoms skipcols ncols offset comment')
+
+
+def read_xyz_header(file_path, offset=0):
+    """Reads the two header lines of the XYZ frame starting at offset.
+
+    Returns an XYZHeader with the atom count (None if the first line is not
+    a count), the number of columns before 'pos' in 'Properties=', the
+    number of columns per atom line and the byte offset of the first atom.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        first = f.readline()
+        comment = f.readline().decode('utf-8', 'replace')
+        offset = f.tell()
+        first_atom = f.readline()
+    try:
+        n_atoms = int(first.split()[0])
+    except (IndexError, ValueError):
+        n_atoms = None
+    skipcols = 0
+    if 'Properties=' in comment:
+        meta = comment.split('Properties=')[1] # get properties.
+        meta = meta.split('pos')[0] # get columns before pos.
+        meta = meta.split(':') # separate keys and values.
+        skipcols = sum([int(i) for i in meta[2::3]]) # add columns before pos.
+    ncols = len(first_atom.split())
+    return XYZHeader(n_atoms, skipcols, ncols, offset, comment)
+
+
+def parse_xyz_block(block, skipcols, ncols):
+    """Converts a block of complete atom lines to an (n, 3) float array.
+
+    Only the three position columns are converted, so string columns such
+    as the species never reach the float parser.
+    """
+    if _C_LOADTXT:
+        data = np.loadtxt(io.BytesIO(block), usecols=(skipcols, skipcols + 1,
+                                                      skipcols + 2),
+                          comments=None, ndmin=2)
+        return data.reshape((-1, 3))
+    tokens = block.split()
+    data = np.empty((len(tokens) // ncols, 3))
+    for i in range(3):
+        data[:, i] = np.array(tokens[skipcols + i::ncols], dtype=float)
+    return data
+
+
+def iter_xyz_blocks(file_path, header=None, block_size=BLOCK_SIZE):
+    """Yields the atom positions of an XYZ file as (n, 3) float blocks.
+
+    The file is read in blocks of block_size bytes that are cut back to
+    the last complete line.  Reading stops after header.n_atoms lines when
+    the atom count is known.
+    """
+    if header is None:
+        header = read_xyz_header(file_path)
+    remaining = header.n_atoms
+    with open(file_path, 'rb') as f:
+        f.seek(header.offset)
+        for block in _iter_line_blocks(f, None, block_size):
+            if remaining is not None:
+                block = _first_lines(block, remaining)
+                remaining -= block.count(b'\n') + (not block.endswith(b'\n'))
+            if block.strip():
+                yield parse_xyz_block(block, header.skipcols, header.ncols)
+            if remaining is not None and remaining <= 0:
+                break
+
+
+def _iter_line_blocks(f, end, block_size):
+    # Yields blocks of complete lines from the current position of f up to
+    # the byte offset end (or EOF).
+    tail = b''
+    while True:
+        size = block_size
+        if end is not None:
+            size = min(size, end - f.tell())
+        chunk = f.read(size) if size > 0 else b''
+        if not chunk:
+            if tail:
+                yield tail
+            return
+        block = tail + chunk
+        cut = block.rfind(b'\n') + 1
+        block, tail = block[:cut], block[cut:]
+        if block:
+            yield block
+
+
+def _first_lines(block, n):
+    # Returns the first n lines of a block (or all of them).
+    if block.count(b'\n') <= n:
+        return block
+    newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+    return block[:newlines[n - 1] + 1]
+
+
+def read_xyz_positions(file_path, header=None, block_size=BLOCK_SIZE):
+    """Returns the (n_atoms, 3) positions stored in an XYZ file."""
+    if header is None:
+        header = read_xyz_header(file_path)
+    blocks = iter_xyz_blocks(file_path, header, block_size)
+    if header.n_atoms is None:
+        blocks = list(blocks)
+        if not blocks:
+            return np.zeros((0, 3))
+        return np.concatenate(blocks)
+    data = np.empty((header.n_atoms, 3))
+    filled = 0
+    for block in blocks:
+        data[filled:filled + len(block)] = block
+        filled += len(block)
+    return data[:filled]
+
+
+def _line_aligned_offsets(file_path, start, end, n_chunks):
+    # Splits [start, end) into up to n_chunks byte ranges that begin at the
+    # start of a line.
+    offsets = [start]
+    step = max((end - start) // n_chunks, 1)
+    with open(file_path, 'rb') as f:
+        for i in range(1, n_chunks):
+            f.seek(start + i * step)
+            f.readline()
+            offset = min(f.tell(), end)
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    if offsets[-1] < end:
+        offsets.append(end)
+    return offsets
+
+
+def _count_rows(block):
+    # Number of non-blank lines in a block of complete lines, i.e. the
+    # number of rows parse_xyz_block returns for it.
+    text = b'\n' + block
+    if not text.endswith(b'\n'):
+        text += b'\n'
+    return text.count(b'\n') - 1 - len(_BLANK_LINE.findall(text))
+
+
+def _count_lines(args):
+    file_path, start, end = args
+    count = 0
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        for block in _iter_line_blocks(f, end, BLOCK_SIZE):
+            count += _count_rows(block)
+    return count
+
+
+def _parse_chunk(args):
+    # Worker: parses one line-aligned byte range and writes its rows into the
+    # shared result buffer starting at row.
+    file_path, start, end, row, skipcols, ncols, spec = args
+    with SharedArray.attach(spec) as shared:
+        data = shared.array
+        parsed = 0
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            for block in _iter_line_blocks(f, end, BLOCK_SIZE):
+                if not block.strip():
+                    continue
+                block = parse_xyz_block(block, skipcols, ncols)
+                stop = min(row + parsed + len(block), len(data))
+                data[row + parsed:stop] = block[:stop - row - parsed]
+                parsed += len(block)
+        del data
+    return parsed
+
+
+def read_xyz_positions_parallel(file_path, header=None, end=None,
+                                processes=None, chunks_per_process=4):
+    """Returns the atom positions of an XYZ file, parsed by a process pool.
+
+    The atom section (header.offset to end) is split into line-aligned byte
+    ranges.  end defaults to the end of the header.n_atoms atom lines, or
+    EOF if the atom count is unknown.  A first pass counts the non-blank
+    lines of every range to give each its first row, then every worker
+    parses its range and writes the rows straight into a shared memory
+    buffer, so no arrays are pickled between processes.
+    """
+    if header is None:
+        header = read_xyz_header(file_path)
+    if end is None:
+        end = _atoms_end(file_path, header)
+    if processes is None:
+        processes = mp.cpu_count()
+    n_chunks = max(processes * chunks_per_process, 1)
+    if end - header.offset < n_chunks * MIN_CHUNK_SIZE:
+        n_chunks = max((end - header.offset) // MIN_CHUNK_SIZE, 1)
+    if processes == 1 or n_chunks == 1:
+        return read_xyz_positions(file_path, header)
+
+    offsets = _line_aligned_offsets(file_path, header.offset, end, n_chunks)
+    ranges = list(zip(offsets[:-1], offsets[1:]))
+    with process_pool(processes) as pool:
+        counts = pool.map(_count_lines,
+                          [(file_path, a, b) for a, b in ranges])
+        rows = np.concatenate([[0], np.cumsum(counts)[:-1]]).tolist()
+        n_rows = sum(counts)
+        if header.n_atoms is not None:
+            n_rows = min(n_rows, header.n_atoms)
+        if n_rows == 0:
+            return np.zeros((0, 3))
+        with SharedArray((n_rows, 3), float) as shared:
+            jobs = [(file_path, a, b, row, header.skipcols, header.ncols,
+                     shared.spec())
+                    for (a, b), row in zip(ranges, rows)]
+            parsed = sum(pool.map(_parse_chunk, jobs))
+            data = shared.array[:min(parsed, n_rows)].copy()
+    return data
+
+
+def _atoms_end(file_path, header):
+    # Byte offset after the atom lines of header (EOF if the count is
+    # unknown or the file ends first).
+    if header.n_atoms is not None:
+        with open(file_path, 'rb') as f:
+            f.seek(header.offset)
+            end = _skip_lines(f, header.n_atoms)
+        if end is not None:
+            return end
+    return os.path.getsize(file_path)
+
+
+def _skip_lines(f, n, block_size=BLOCK_SIZE):
+    # Moves f past the next n lines and returns the new offset, or None if
+    # the file ends first.
+    while n > 0:
+        start = f.tell()
+        # atom lines are well under 128 bytes, so small frames cost one
+        # small read instead of a full block
+        block = f.read(min(block_size, max(n * 128, 4096)))
+        if not block:
+            return None
+        count = block.count(b'\n')
+        if count >= n:
+            newlines = np.flatnonzero(
+                np.frombuffer(block, dtype=np.uint8) == 10)
+            f.seek(start + int(newlines[n - 1]) + 1)
+            return f.tell()
+        n -= count
+    return f.tell()
+
+
+def scan_frames(file_path):
+    """Returns the byte offsets and atom counts of every frame in one pass.
+
+    Only the count line of each frame is parsed; the atom lines are skipped
+    by counting newlines in large blocks.
+    """
+    offsets, counts = [], []
+    with open(file_path, 'rb') as f:
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            if not line.strip(): # blank lines between frames
+                continue
+            n_atoms = int(line.split()[0])
+            if _skip_lines(f, n_atoms + 1) is None:
+                break # truncated last frame
+            offsets.append(offset)
+            counts.append(n_atoms)
+    return np.array(offsets, dtype=np.int64), np.array(counts, dtype=np.int64)
+
+
+class XYZTrajectory(object):
+    """Random access to the frames of a multi-frame XYZ dump.
+
+    The frame index is built by one scan of the file and saved next to it
+    as '<file>.frames.npz', keyed by the file's size, mtime and content
+    hash, so later opens skip the scan.
+    """
+
+    def __init__(self, file_path, save_index=True):
+        self.file_path = str(file_path)
+        self.index_path = self.file_path + '.frames.npz'
+        self.offsets, self.n_atoms = self._load_index()
+        if self.offsets is None:
+            self.offsets, self.n_atoms = scan_frames(self.file_path)
+            if save_index:
+                self._save_index()
+        self.size = os.path.getsize(self.file_path)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return None, None
+        try:
+            with np.load(self.index_path) as index:
+                key = str(index['key'])
+                offsets, n_atoms = index['offsets'], index['n_atoms']
+        except (OSError, ValueError, KeyError):
+            return None, None
+        if key != repr(sorted(source_key(self.file_path).items())):
+            return None, None
+        return offsets, n_atoms
+
+    def _save_index(self):
+        key = repr(sorted(source_key(self.file_path).items()))
+        try:
+            with open(self.index_path, 'wb') as f:
+                np.savez(f, offsets=self.offsets, n_atoms=self.n_atoms,
+                         key=np.array(key))
+        except OSError:
+            pass # read-only location, rescan next time
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _frame(self, frame):
+        frame = int(frame)
+        if frame < 0:
+            frame += len(self)
+        if not 0 <= frame < len(self):
+            raise IndexError('frame {} out of range'.format(frame))
+        return frame
+
+    def header(self, frame):
+        """Returns the XYZHeader of one frame."""
+        return read_xyz_header(self.file_path,
+                               int(self.offsets[self._frame(frame)]))
+
+    def end(self, frame):
+        """Returns the byte offset where a frame ends."""
+        frame = self._frame(frame)
+        if frame + 1 < len(self):
+            return int(self.offsets[frame + 1])
+        return self.size
+
+    def positions(self, frame, processes=1):
+        """Returns the (n_atoms, 3) positions of one frame."""
+        header = self.header(frame)
+        if processes == 1:
+            return read_xyz_positions(self.file_path, header)
+        return read_xyz_positions_parallel(self.file_path, header,
+                                           self.end(frame), processes)
+
+    def frames(self, frames=None):
+        """Returns the frame numbers selected by an int, slice or list."""
+        if frames is None:
+            return list(range(len(self)))
+        if isinstance(frames, slice):
+            return list(range(*frames.indices(len(self))))
+        if np.ndim(frames) == 0:
+            return [self._frame(frames)]
+        return [self._frame(i) for i in frames]
@@ -0,0 +1,17 @@
+from setuptools import setup
+
+setup(
+    name='aquami3D',
+    version='0.1.0',
+    description='Quantifies the 3D microstructure of nanoporous, '
+                'bicontinuous or foam structures.',
+    url='https://github.com/JStuckner/Aquami3D',
+    license='MIT',
+    packages=['aquami3D'],
+    python_requires='>=3.8',
+    install_requires=['numpy', 'scipy', 'scikit-image', 'tifffile'],
+    extras_require={'gui': ['PyQt5', 'vtk', 'matplotlib']},
+    entry_points={
+        'console_scripts': ['aquami3d = aquami3D.cli:main'],
+    },
+)
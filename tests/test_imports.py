@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules the headless entry points must not load.
+GUI_MODULES = ('PyQt5', 'vtk', 'matplotlib')
+
+
+@pytest.mark.parametrize('module', ['aquami3D.measure', 'aquami3D.cli'])
+def test_headless_import(module):
+    code = ('import sys, {}\n'
+            'print(" ".join(m for m in {!r} if m in sys.modules))'
+            .format(module, GUI_MODULES))
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    assert out.stdout.split() == []
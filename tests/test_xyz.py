@@ -0,0 +1,21 @@
+import numpy as np
+
+from aquami3D import xyz
+
+
+def write_xyz(path, lines):
+    path.write_text('%d\nProperties=species:S:1:pos:R:3\n' % len(lines)
+                    + '\n'.join(lines) + '\n')
+    return str(path)
+
+
+def test_parallel_reader_skips_blank_lines(tmp_path, monkeypatch):
+    atoms = ['Cu %d.5 %d.25 %d.125' % (i, 2 * i, 3 * i) for i in range(400)]
+    atoms[150] = ''
+    atoms[151] = '   '
+    file_path = write_xyz(tmp_path / 'atoms.xyz', atoms)
+    monkeypatch.setattr(xyz, 'MIN_CHUNK_SIZE', 256)
+    expected = xyz.read_xyz_positions(file_path)
+    parallel = xyz.read_xyz_positions_parallel(file_path, processes=2)
+    assert len(expected) == 398
+    np.testing.assert_array_equal(parallel, expected)